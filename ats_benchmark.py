@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for ats9462.acquire_NPT on the simulated board.
+
+Sweeps record length, records per buffer and buffer count for each
+processing mode and reports the achieved transfer rate and the headroom,
+i.e. the fraction of each buffer period left after processing it. Negative
+headroom or OVERFLOW means the mode can't keep up at that trigger rate.
+The simulated board doesn't fill the buffers, so only the host side of the
+loop is timed; the data is whatever the buffers held before.
+
+usage:
+    python ats_benchmark.py --trigger-rate 100e3 --modes raw writer iq
+"""
+import os
+os.environ.setdefault('ATS_SIMULATE', '1')
+
+import argparse
+import contextlib
+import io
+import itertools
+import tempfile
+import numpy as np
+import ats_module
+
+def run_mode(digitizer, mode, filename, **kwargs):
+    # runs one acquisition in the given processing mode
+    if mode == 'raw':
+        digitizer.acquire_NPT(filename = filename, **kwargs)
+    elif mode == 'writer':
+        digitizer.acquire_NPT(filename = filename, use_writer_thread = True,
+                              **kwargs)
+    elif mode == 'array':
+        digitizer.acquire_NPT(save_data = False, return_data = 'array',
+                              **kwargs)
+    elif mode == 'average':
+        digitizer.acquire_average(**kwargs)
+    elif mode == 'iq':
+        digitizer.acquire_iq(10e6, **kwargs)
+    elif mode == 'multitone':
+        digitizer.acquire_multitone([10e6, 20e6, 30e6, 40e6], **kwargs)
+    else:
+        raise ValueError('Unknown mode: ' + mode)
+
+MODES = ('raw', 'writer', 'array', 'average', 'iq', 'multitone')
+
+def benchmark(modes = MODES,
+              record_lengths = (1e-6, 4e-6, 16e-6),
+              records_per_buffer = (16, 128, 1024),
+              buffer_counts = (4, 16),
+              channel_str = 'AB',
+              trigger_rate = 100e3,
+              duration = 0.2):
+    # returns a list of result dicts, one per mode and buffer geometry
+    # trigger_rate = float: simulated records per second
+    # duration = float: approximate length of each acquisition in seconds
+    digitizer = ats_module.ats9462()
+    # filling buffers would run inside postAsyncBuffer and
+    # waitAsyncBufferComplete and be counted as repost and wait time
+    digitizer.board.fill = False
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'benchmark.bin')
+        for mode, record_length, recordsPerBuffer, buffer_count in \
+                itertools.product(modes, record_lengths, records_per_buffer,
+                                  buffer_counts):
+            digitizer.board.trigger_rate = trigger_rate
+            buffersPerAcquisition = max(8, int(duration * trigger_rate /
+                                               recordsPerBuffer))
+            period = recordsPerBuffer / trigger_rate
+            result = {'mode': mode, 'record_length': record_length,
+                      'recordsPerBuffer': recordsPerBuffer,
+                      'buffer_count': buffer_count}
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run_mode(digitizer, mode, filename,
+                             record_length = record_length,
+                             recordsPerBuffer = recordsPerBuffer,
+                             buffersPerAcquisition = buffersPerAcquisition,
+                             buffer_count = buffer_count,
+                             channel_str = channel_str)
+            except Exception as e:
+                result.update(MBps = 0.0, headroom = None, error = str(e))
+            else:
+                stats = digitizer.last_stats
+                busy = np.median(stats.busy()) if stats.buffers else 0.0
+                result.update(MBps = stats.throughput() / 1e6,
+                              headroom = 1 - busy / period,
+                              near_overflow = stats.near_overflow_count(),
+                              error = None)
+            results.append(result)
+        digitizer.free_buffers()
+    return results
+
+def print_results(results):
+    print('%-10s %10s %8s %6s %10s %9s' % ('mode', 'record_us', 'rec/buf',
+                                           'bufs', 'MB/s', 'headroom'))
+    for r in results:
+        if r['error']:
+            status = 'OVERFLOW' if 'Overflow' in r['error'] else 'ERROR'
+        else:
+            status = '%8.1f%%' % (100 * r['headroom'])
+        print('%-10s %10.1f %8d %6d %10.1f %9s' %
+              (r['mode'], 1e6 * r['record_length'], r['recordsPerBuffer'],
+               r['buffer_count'], r['MBps'], status))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--modes', nargs = '+', default = MODES,
+                        choices = MODES)
+    parser.add_argument('--trigger-rate', type = float, default = 100e3)
+    parser.add_argument('--duration', type = float, default = 0.2)
+    parser.add_argument('--channels', default = 'AB',
+                        choices = ('A', 'B', 'AB'))
+    args = parser.parse_args()
+    print_results(benchmark(args.modes, channel_str = args.channels,
+                            trigger_rate = args.trigger_rate,
+                            duration = args.duration))
@@ -4,25 +4,142 @@ Created on Sat Nov 17 13:38:52 2018
 
 @author: Ben
 """
-import atsapi as ats
 import time
 import os
+# ats_sim_module simulates the board, see its docstring. It is only used
+# when asked for, so a broken driver install can't pass synthetic data off
+# as real
+simulated = bool(os.environ.get('ATS_SIMULATE'))
+if simulated:
+    import ats_sim_module as ats
+else:
+    import atsapi as ats
 import math
 import ctypes
+import sys
+import threading
+import queue
+import collections
+import tempfile
+import json
+import struct
+import numpy as np
+import concurrent.futures
+from multiprocessing import shared_memory
 
+# default sample rate in Hz, see get_default_params. Acquisitions use the
+# rate of the applied config, see ats9462.set_sample_rate
 samplesPerSec = 180000000.0
+
+# atsapi internal clock flags by sample rate in Hz
+_sample_rate_names = {1e3: 'SAMPLE_RATE_1KSPS', 2e3: 'SAMPLE_RATE_2KSPS',
+                      5e3: 'SAMPLE_RATE_5KSPS', 1e4: 'SAMPLE_RATE_10KSPS',
+                      2e4: 'SAMPLE_RATE_20KSPS', 5e4: 'SAMPLE_RATE_50KSPS',
+                      1e5: 'SAMPLE_RATE_100KSPS', 2e5: 'SAMPLE_RATE_200KSPS',
+                      5e5: 'SAMPLE_RATE_500KSPS', 1e6: 'SAMPLE_RATE_1MSPS',
+                      2e6: 'SAMPLE_RATE_2MSPS', 5e6: 'SAMPLE_RATE_5MSPS',
+                      1e7: 'SAMPLE_RATE_10MSPS', 2e7: 'SAMPLE_RATE_20MSPS',
+                      5e7: 'SAMPLE_RATE_50MSPS', 1e8: 'SAMPLE_RATE_100MSPS',
+                      1.25e8: 'SAMPLE_RATE_125MSPS',
+                      1.6e8: 'SAMPLE_RATE_160MSPS',
+                      1.8e8: 'SAMPLE_RATE_180MSPS'}
+sample_rate_flags = {rate: getattr(ats, name)
+                     for rate, name in _sample_rate_names.items()
+                     if hasattr(ats, name)}
+
+class acquisition_config(collections.namedtuple('acquisition_config', (
+        'clock_params',
+        'channel_A_params', 'channel_A_bandwidth',
+        'channel_B_params', 'channel_B_bandwidth',
+        'trigger_params', 'external_trigger_params',
+        'trigger_delay', 'trigger_timeout',
+        'aux_io_params'))):
+    # board settings, immutable and hashable. Fields hold the arguments of
+    # the atsapi call that applies them, see ats9462.apply_config
+    # clock_params = (source, rate, edge, decimation): setCaptureClock
+    # channel_X_params = (channel, coupling, input range, impedance):
+    #   inputControlEx
+    # channel_X_bandwidth = int: setBWLimit, 1 limits the bandwidth
+    # trigger_params = setTriggerOperation arguments
+    # external_trigger_params = (coupling, range): setExternalTrigger
+    # trigger_delay = int: in samples
+    # trigger_timeout = int: in 10 us ticks, 0 waits forever
+    # aux_io_params = (mode, parameter): configureAuxIO
+    # Make a variant with _replace, e.g.
+    #   config._replace(channel_A_params = (ats.CHANNEL_A, ats.DC_COUPLING,
+    #                   ats.INPUT_RANGE_PM_400_MV, ats.IMPEDANCE_50_OHM))
+    # or with_sample_rate for the clock
+    __slots__ = ()
+
+    def clock_rate(self):
+        # clock rate in Hz, before decimation
+        source, rate, edge, decimation = self.clock_params
+        if source == ats.INTERNAL_CLOCK:
+            for clock_rate, flag in sample_rate_flags.items():
+                if flag == rate:
+                    return clock_rate
+            raise ValueError('Unknown sample rate flag: %r' % rate)
+        return float(rate)
+
+    @property
+    def samplesPerSec(self):
+        # sample rate in Hz after decimation, i.e. of the acquired data
+        decimation = self.clock_params[3]
+        return self.clock_rate() / max(decimation, 1)
+
+    def with_sample_rate(self, sample_rate = None, decimation = None):
+        # returns a copy clocked at sample_rate with the given decimation,
+        # keeping the trigger delay the same in seconds
+        # sample_rate = float: clock rate in Hz before decimation, one of
+        #   sample_rate_flags for the internal clock. None keeps the current
+        # decimation = int: keep every decimation-th sample, 0 disables.
+        #   None keeps the current
+        source, rate, edge, old_decimation = self.clock_params
+        if decimation is None:
+            decimation = old_decimation
+        if decimation < 0 or decimation != int(decimation):
+            raise ValueError('decimation must be a non-negative integer')
+        if sample_rate is not None:
+            if source == ats.INTERNAL_CLOCK:
+                if sample_rate not in sample_rate_flags:
+                    raise ValueError('%g Hz is not an internal clock rate, '
+                                     'use one of %s' % (sample_rate,
+                                     sorted(sample_rate_flags)))
+                rate = sample_rate_flags[sample_rate]
+            else:
+                rate = int(sample_rate)
+        config = self._replace(clock_params = (source, rate, edge,
+                                               int(decimation)))
+        trigger_delay = int(round(self.trigger_delay * config.samplesPerSec /
+                                  self.samplesPerSec))
+        return config._replace(trigger_delay = trigger_delay)
+
+# the call that applies each field of acquisition_config, in the order the
+# board is programmed
+_config_calls = {
+    'clock_params': lambda board, p: board.setCaptureClock(*p),
+    'channel_A_params': lambda board, p: board.inputControlEx(*p),
+    'channel_A_bandwidth': lambda board, p: board.setBWLimit(ats.CHANNEL_A, p),
+    'channel_B_params': lambda board, p: board.inputControlEx(*p),
+    'channel_B_bandwidth': lambda board, p: board.setBWLimit(ats.CHANNEL_B, p),
+    'trigger_params': lambda board, p: board.setTriggerOperation(*p),
+    'external_trigger_params': lambda board, p: board.setExternalTrigger(*p),
+    'trigger_delay': lambda board, p: board.setTriggerDelay(p),
+    'trigger_timeout': lambda board, p: board.setTriggerTimeOut(p),
+    'aux_io_params': lambda board, p: board.configureAuxIO(*p)}
+
 def get_default_params():
     # internal: ats.INTERNAL_CLOCK
     #   - sample rate -> flag from atsapi
     # external ref: ats.EXTERNAL_CLOCK_10MHz_REF
     #   - sample rate -> int in Hz
+    # the rate is the module's samplesPerSec, change the rate of a config
+    # with acquisition_config.with_sample_rate
     clock_source = ats.INTERNAL_CLOCK
-    global samplesPerSec
-    samplesPerSec = 180000000.0 # NEED TO CHANGE BOTH THIS AND THE ATS FLAG
     if clock_source == ats.EXTERNAL_CLOCK_10MHz_REF:
         sample_rate = int(samplesPerSec)
     elif clock_source == ats.INTERNAL_CLOCK:
-        sample_rate = ats.SAMPLE_RATE_180MSPS
+        sample_rate = sample_rate_flags[samplesPerSec]
     else:
         print('Unexpected Clock Source!')
     clock_edge = ats.CLOCK_EDGE_RISING
@@ -74,78 +191,1660 @@ def get_default_params():
     aux_param = 18
     aux_io_params = (aux_mode, aux_param)
     
-    return  clock_params, \
-            channel_A_params, channel_A_bandwidth, \
-            channel_B_params, channel_B_bandwidth, \
-            trigger_params, external_trigger_params, \
-            trigger_delay, trigger_timeout, \
-            aux_io_params
+    return acquisition_config(clock_params,
+                              channel_A_params, channel_A_bandwidth,
+                              channel_B_params, channel_B_bandwidth,
+                              trigger_params, external_trigger_params,
+                              trigger_delay, trigger_timeout,
+                              aux_io_params)
+
+def record_samples(record_length, samplesPerSec):
+    # number of samples covering record_length seconds. Rounds away float
+    # error first, so 10 us at 5 MS/s is 50 samples, not 51
+    return math.ceil(round(record_length * samplesPerSec, 6))
+
+def records_view(data, recordsPerBuffer, samplesPerRecord, channelCount):
+    # returns a (records, samples, channels) view of a flat DMA buffer
+    # without copying. Samples of the enabled channels are interleaved
+    # within each record (S0A, S0B, S1A, S1B, ...)
+    return data.reshape(recordsPerBuffer, samplesPerRecord, channelCount)
+
+def channel_mask(channel_str):
+    # returns (atsapi channel mask, number of channels) for 'A', 'B' or 'AB'
+    # TODO: Select the active channels.
+    if channel_str == 'A':
+        channels = ats.CHANNEL_A
+    elif channel_str == 'B':
+        channels = ats.CHANNEL_B
+    elif channel_str == 'AB':
+        channels = ats.CHANNEL_A | ats.CHANNEL_B
+    else:
+        sys.exit('ERROR: Invalid channel string')
+
+    channelCount = 0
+    for c in ats.channels:
+        channelCount += (c & channels == c)
+    return channels, channelCount
+
+def split_channels(data, channelCount):
+    # splits a buffer of interleaved samples into one strided view per
+    # channel, no data is copied
+    # data = buffer.buffer or any array whose last axis runs over
+    #   interleaved samples (S0A, S0B, S1A, S1B, ...)
+    # returns a tuple of channelCount views
+    return tuple(data[..., c::channelCount] for c in range(channelCount))
+
+# full scale of the input ranges in volts, keyed by the atsapi flag
+_input_range_names = (('INPUT_RANGE_PM_20_MV', 0.02),
+                      ('INPUT_RANGE_PM_40_MV', 0.04),
+                      ('INPUT_RANGE_PM_50_MV', 0.05),
+                      ('INPUT_RANGE_PM_80_MV', 0.08),
+                      ('INPUT_RANGE_PM_100_MV', 0.1),
+                      ('INPUT_RANGE_PM_200_MV', 0.2),
+                      ('INPUT_RANGE_PM_400_MV', 0.4),
+                      ('INPUT_RANGE_PM_500_MV', 0.5),
+                      ('INPUT_RANGE_PM_800_MV', 0.8),
+                      ('INPUT_RANGE_PM_1_V', 1.0),
+                      ('INPUT_RANGE_PM_2_V', 2.0),
+                      ('INPUT_RANGE_PM_4_V', 4.0),
+                      ('INPUT_RANGE_PM_5_V', 5.0),
+                      ('INPUT_RANGE_PM_8_V', 8.0),
+                      ('INPUT_RANGE_PM_10_V', 10.0),
+                      ('INPUT_RANGE_PM_16_V', 16.0))
+input_range_volts = {getattr(ats, name): volts
+                     for name, volts in _input_range_names
+                     if hasattr(ats, name)}
+
+class code_converter:
+    # converts unsigned sample codes to volts with one fused multiply-add
+    # into the output array, so converting a buffer allocates nothing
+    # Sample codes are unsigned: 0 is -full scale, 2^bits - 1 is +full scale
+    # full_scale = float: in volts, e.g. 2.0 for INPUT_RANGE_PM_2_V
+    # bitsPerSample = int
+    # dtype = np.float32 or np.float64: float32 halves the memory
+
+    def __init__(self, full_scale, bitsPerSample = 16, dtype = np.float32):
+        self.full_scale = full_scale
+        self.dtype = np.dtype(dtype)
+        mid = ((1 << bitsPerSample) - 1) / 2
+        # volts = code * scale + offset
+        self.scale = self.dtype.type(full_scale / mid)
+        self.offset = self.dtype.type(-full_scale)
+
+    def convert(self, codes, out = None):
+        # codes = integer array, e.g. a DMA buffer or a strided channel view
+        # out = array of self.dtype with the same shape, reused if given
+        if out is None:
+            out = np.empty(codes.shape, dtype = self.dtype)
+        np.multiply(codes, self.scale, out = out, dtype = self.dtype,
+                    casting = 'unsafe')
+        out += self.offset
+        return out
+
+def allocate_data_array(buffersPerAcquisition, recordsPerBuffer,
+                        samplesPerRecord, channelCount, dtype = np.uint16,
+                        max_memory_bytes = None, spill_filename = None):
+    # allocates one contiguous array shaped
+    # (buffers, records, samples, channels) for acquire_NPT to copy into
+    # max_memory_bytes = int: if the array is larger than this, it is backed
+    #   by a memory-mapped file instead of RAM
+    # spill_filename = str: file used for the memory map, a temporary file
+    #   is created if unspecified
+    shape = (buffersPerAcquisition, recordsPerBuffer,
+             samplesPerRecord, channelCount)
+    nbytes = np.dtype(dtype).itemsize
+    for n in shape:
+        nbytes *= n
+    if max_memory_bytes is None or nbytes <= max_memory_bytes:
+        return np.empty(shape, dtype = dtype)
+    if spill_filename is None:
+        spill_file = tempfile.NamedTemporaryFile(suffix = '.dat',
+                                                 delete = False)
+        spill_filename = spill_file.name
+        spill_file.close()
+    print('Data (%d bytes) exceeds memory cap, spilling to %s' %
+          (nbytes, spill_filename))
+    return np.memmap(spill_filename, dtype = dtype, mode = 'w+',
+                     shape = shape)
+
+"""
+*******************************************************************************
+CAPTURE FILES
+A capture file is a fixed-size header followed by the raw buffers exactly as
+they came off the board, so the data can be opened with np.memmap.
+Header layout (little endian):
+    8 bytes     magic, CAPTURE_MAGIC
+    uint32      format version
+    uint32      data offset in bytes (multiple of CAPTURE_HEADER_SIZE)
+    uint32      length of the JSON metadata in bytes
+    JSON        metadata (acquisition parameters, layout, dtype, timestamps)
+    zero padding up to the data offset
+*******************************************************************************
+"""
+
+CAPTURE_MAGIC = b'ATSCAPT\x00'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER_SIZE = 4096
+_capture_prefix = struct.Struct('<8sIII')
+
+def params_to_dict(params):
+    # converts an acquisition_config to a dict that can be stored in a
+    # capture header
+    return dict(zip(acquisition_config._fields, params))
+
+def write_capture_header(dataFile, metadata, data_offset = None):
+    # writes the header at the start of dataFile and leaves the file position
+    # at the start of the data
+    # metadata = dict: must be JSON serializable
+    # data_offset = int: pass the offset of an existing header to rewrite it
+    #   in place, e.g. to fill in the stop time at the end of a capture
+    meta_bytes = json.dumps(metadata).encode('utf-8')
+    size = _capture_prefix.size + len(meta_bytes)
+    if data_offset is None:
+        # leave room for the header to grow when it is rewritten
+        data_offset = CAPTURE_HEADER_SIZE * \
+            ((size + 512) // CAPTURE_HEADER_SIZE + 1)
+    elif size > data_offset:
+        raise ValueError('Capture header no longer fits before the data')
+    dataFile.seek(0)
+    dataFile.write(_capture_prefix.pack(CAPTURE_MAGIC, CAPTURE_VERSION,
+                                        data_offset, len(meta_bytes)))
+    dataFile.write(meta_bytes)
+    dataFile.write(b'\x00' * (data_offset - size))
+    return data_offset
+
+def finish_capture_header(dataFile, metadata, data_offset, lists = ()):
+    # rewrites the header at the end of a capture. If the lists named in
+    # lists (e.g. dropped buffers) make it too long for the space before the
+    # data, they are moved to a JSON sidecar, filename + '.json', which the
+    # header names under 'sidecar'
+    try:
+        write_capture_header(dataFile, metadata, data_offset)
+    except ValueError:
+        sidecar = dataFile.name + '.json'
+        with open(sidecar, 'w') as f:
+            json.dump({key: metadata[key] for key in lists}, f)
+        for key in lists:
+            metadata[key] = None
+        metadata['sidecar'] = os.path.basename(sidecar)
+        write_capture_header(dataFile, metadata, data_offset)
+
+def index_ranges(indices):
+    # compacts sorted indices to [[start, count], ...] runs
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][0] + ranges[-1][1] == i:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([i, 1])
+    return ranges
+
+def read_capture_header(filename):
+    # returns (metadata, data_offset) of a capture file
+    with open(filename, 'rb') as f:
+        magic, version, data_offset, meta_len = \
+            _capture_prefix.unpack(f.read(_capture_prefix.size))
+        if magic != CAPTURE_MAGIC:
+            raise ValueError('%s is not an ATS capture file' % filename)
+        if version > CAPTURE_VERSION:
+            raise ValueError('Capture file version %d is not supported' %
+                             version)
+        metadata = json.loads(f.read(meta_len).decode('utf-8'))
+    return metadata, data_offset
+
+def load_capture(filename, mode = 'r'):
+    # opens a capture file without reading the data
+    # mode = str: np.memmap mode, 'r' or 'r+'
+    # returns (data, metadata) with data a memory-mapped array shaped
+    #   (buffers, records, samples, channels)
+    metadata, data_offset = read_capture_header(filename)
+    shape = (metadata['buffers_saved'], metadata['recordsPerBuffer'],
+             metadata['samplesPerRecord'], metadata['channelCount'])
+    if shape[0] == 0:
+        return np.zeros(shape, dtype = metadata['dtype']), metadata
+    data = np.memmap(filename, dtype = metadata['dtype'], mode = mode,
+                     offset = data_offset, shape = shape)
+    return data, metadata
+
+class ats_capture:
+    # lazy reader for capture files written by ats9462.acquire_NPT
+    # nothing is read from disk until the data is indexed or iterated over
+    # filename = str
+    # capture[buffer, record, channel, sample] indexes the memory map through
+    #   a strided view, so slices are not copied
+    # usage:
+    #   cap = ats_capture('data.bin')
+    #   a = cap.channel('A')[:, :100]   # first 100 records of every buffer
+    #   mean = cap.process(record_averager())
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data, self.metadata = load_capture(filename)
+        self.channel_str = self.metadata['channel_str']
+        self.samplesPerSec = self.metadata['samplesPerSec']
+        self.buffers, self.recordsPerBuffer, self.samplesPerRecord, \
+            self.channelCount = self.data.shape
+        self.records = self.buffers * self.recordsPerBuffer
+        self.zero_code = 1 << (8 * self.metadata['bytesPerSample'] - 1)
+
+    @property
+    def shape(self):
+        # (buffers, records, channels, samples)
+        return (self.buffers, self.recordsPerBuffer, self.channelCount,
+                self.samplesPerRecord)
+
+    def __len__(self):
+        return self.buffers
+
+    def __getitem__(self, index):
+        return np.moveaxis(self.data, 3, 2)[index]
+
+    def channel(self, channel):
+        # returns a (buffers, records, samples) view of one channel, the
+        # interleaved samples are split by striding, not copying
+        # channel = str: 'A' or 'B'
+        return self.data[..., self.channel_str.index(channel)]
+
+    def time_axis(self):
+        # returns the sample times in seconds relative to the trigger
+        return (np.arange(self.samplesPerRecord) -
+                self.metadata['preTriggerSamples']) / self.samplesPerSec
+
+    def iter_chunks(self, records_per_chunk = None):
+        # yields consecutive (records, samples, channels) blocks of at most
+        # records_per_chunk records, read lazily from the file
+        # records_per_chunk = int: defaults to one buffer
+        if records_per_chunk is None:
+            records_per_chunk = self.recordsPerBuffer
+        flat = self.data.reshape(self.records, self.samplesPerRecord,
+                                 self.channelCount)
+        for i in range(0, self.records, records_per_chunk):
+            yield flat[i:i + records_per_chunk]
+
+    def process(self, processor, records_per_chunk = None):
+        # runs a buffer processor (record_averager, iq_demodulator, ...) over
+        # the capture chunk by chunk and returns its result, so reductions
+        # don't need the whole file in memory
+        if records_per_chunk is None:
+            records_per_chunk = self.recordsPerBuffer
+        chunks = -(-self.records // records_per_chunk)
+        processor.start(acquisition_info(self.channel_str, self.channelCount,
+                                         self.samplesPerSec,
+                                         self.metadata['preTriggerSamples'],
+                                         self.samplesPerRecord,
+                                         records_per_chunk, chunks,
+                                         self.metadata['bytesPerSample']))
+        try:
+            for chunk in self.iter_chunks(records_per_chunk):
+                processor.process(chunk)
+                if processor_done(processor):
+                    break
+        finally:
+            processor_close(processor)
+        return processor.result()
+
+    def mean(self, records_per_chunk = None):
+        # returns the mean record in sample codes, shape (samples, channels)
+        return self.process(record_averager(), records_per_chunk)
+
+class acquisition_info:
+    # describes the shape of an acquisition; handed to buffer processors
+    # before the capture starts so they can allocate their workspaces
+
+    def __init__(self, channel_str, channelCount, samplesPerSec,
+                 preTriggerSamples, samplesPerRecord, recordsPerBuffer,
+                 buffersPerAcquisition, bytesPerSample):
+        self.channel_str = channel_str
+        self.channelCount = channelCount
+        self.samplesPerSec = samplesPerSec
+        self.preTriggerSamples = preTriggerSamples
+        self.samplesPerRecord = samplesPerRecord
+        self.recordsPerBuffer = recordsPerBuffer
+        self.buffersPerAcquisition = buffersPerAcquisition
+        self.bytesPerSample = bytesPerSample
+        self.sample_dtype = np.uint16 if bytesPerSample > 1 else np.uint8
+        # code of a ~0V input
+        self.zero_code = 1 << (8 * bytesPerSample - 1)
+
+"""
+*******************************************************************************
+BUFFER PROCESSORS
+A processor is handed every filled DMA buffer by acquire_NPT before the
+buffer is posted back to the board. It implements:
+    start(info)     - info = acquisition_info, allocate workspaces here
+    process(records) - records = (records, samples, channels) view of the
+                       DMA buffer; only valid until the method returns
+    result()        - returned by acquire_NPT
+and optionally
+    done            - attribute; once it is True the acquisition stops
+                      early and the board is aborted cleanly
+    close()         - called once the acquisition ends, also when it fails,
+                      before result(); release processes, shared memory,
+                      files, ... here
+*******************************************************************************
+"""
+
+def processor_done(processor):
+    # True once a processor asks for the acquisition to stop
+    return processor is not None and getattr(processor, 'done', False)
+
+def processor_close(processor):
+    # runs the cleanup hook of a processor, if it has one
+    if processor is not None and hasattr(processor, 'close'):
+        processor.close()
+
+class record_averager:
+    # averages records per channel and sample without keeping raw data
+    # return_variance = bool: also return the per-sample variance
+
+    def __init__(self, return_variance = False):
+        self.return_variance = return_variance
+
+    def start(self, info):
+        # exact integer sums of codes relative to 0V; squares of 16 bit codes
+        # summed over 10^9 records still fit in an int64
+        self.zero_code = info.zero_code
+        shape = (info.samplesPerRecord, info.channelCount)
+        self.sum = np.zeros(shape, dtype = np.int64)
+        self.sum_sq = np.zeros(shape, dtype = np.int64)
+        self.centered = np.empty((info.recordsPerBuffer,) + shape,
+                                 dtype = np.int64)
+        self.count = 0
+
+    def process(self, records):
+        n = records.shape[0]
+        centered = self.centered[:n]
+        centered[...] = records
+        centered -= self.zero_code
+        self.sum += centered.sum(axis = 0)
+        if self.return_variance:
+            np.multiply(centered, centered, out = centered)
+            self.sum_sq += centered.sum(axis = 0)
+        self.count += n
+
+    def result(self):
+        # returns the mean record in sample codes, shape (samples, channels)
+        # and optionally the variance
+        count = max(self.count, 1)
+        mean = self.sum / count
+        if self.return_variance:
+            variance = self.sum_sq / count - mean**2
+            return mean + self.zero_code, variance
+        return mean + self.zero_code
+
+# reference tables are reused across acquisitions with the same frequencies,
+# window and sample rate
+_demodulation_tables = {}
+
+def demodulation_table(if_freqs, start_ind, stop_ind, preTriggerSamples,
+                       samplesPerSec):
+    # returns a (window samples, 2*N) table for N IF frequencies with columns
+    # 2/n*cos and -2/n*sin for each frequency, so that
+    # (records x samples) . (samples x 2N) gives I and Q side by side and
+    # the product can be viewed as (records, N) complex without a copy
+    # The phase reference is the trigger, so points from different
+    # acquisitions can be compared directly
+    key = (tuple(if_freqs), start_ind, stop_ind, preTriggerSamples,
+           samplesPerSec)
+    if key not in _demodulation_tables:
+        if len(_demodulation_tables) >= 32:
+            _demodulation_tables.clear()
+        t = (np.arange(start_ind, stop_ind) - preTriggerSamples) / \
+            samplesPerSec
+        phase = 2 * np.pi * np.outer(t, if_freqs)
+        table = np.empty((stop_ind - start_ind, 2 * len(if_freqs)))
+        table[:, 0::2] = np.cos(phase)
+        table[:, 1::2] = -np.sin(phase)
+        table *= 2 / (stop_ind - start_ind)
+        table.flags.writeable = False
+        _demodulation_tables[key] = table
+    return _demodulation_tables[key]
+
+class multitone_demodulator:
+    # demodulates every record against several IF frequencies at once, for
+    # frequency-multiplexed readout
+    # if_freqs = list of floats: in Hz
+    # window_start = float: start of the integration window in seconds,
+    #   relative to the start of the record
+    # window_length = float: in seconds, defaults to the rest of the record
+    # channel = str: 'A' or 'B', must be one of the acquired channels
+
+    def __init__(self, if_freqs, window_start = 0, window_length = None,
+                 channel = 'A'):
+        self.if_freqs = list(if_freqs)
+        self.window_start = window_start
+        self.window_length = window_length
+        self.channel = channel
+        self.work = None
+
+    def start(self, info):
+        if info.buffersPerAcquisition is None:
+            raise ValueError('An unbounded stream needs max_buffers to '
+                             'size the IQ result')
+        self.prepare(info)
+        self.iq = np.empty((info.buffersPerAcquisition *
+                            info.recordsPerBuffer, self.table.shape[1]))
+        self.count = 0
+
+    def prepare(self, info):
+        # sets up the reference table and workspace without allocating the
+        # result array, for processors that demodulate buffer by buffer
+        self.channel_ind = info.channel_str.index(self.channel)
+        self.start_ind = int(round(self.window_start * info.samplesPerSec))
+        if self.window_length is None:
+            self.stop_ind = info.samplesPerRecord
+        else:
+            self.stop_ind = self.start_ind + \
+                int(round(self.window_length * info.samplesPerSec))
+        if not 0 <= self.start_ind < self.stop_ind <= info.samplesPerRecord:
+            raise ValueError('Integration window does not fit in the record')
+        self.table = demodulation_table(self.if_freqs, self.start_ind,
+                                        self.stop_ind,
+                                        info.preTriggerSamples,
+                                        info.samplesPerSec)
+        # the 0V code is a constant offset, remove it after the product
+        self.offset = info.zero_code * self.table.sum(axis = 0)
+        work_shape = (info.recordsPerBuffer, self.stop_ind - self.start_ind)
+        if self.work is None or self.work.shape != work_shape:
+            self.work = np.empty(work_shape)
+
+    def demodulate(self, records, out):
+        # writes I and Q of every record side by side into out, a float
+        # array shaped (records, 2N)
+        n = records.shape[0]
+        self.work[:n] = records[:, self.start_ind:self.stop_ind,
+                                self.channel_ind]
+        np.matmul(self.work[:n], self.table, out = out)
+        out -= self.offset
+
+    def process(self, records):
+        n = records.shape[0]
+        self.demodulate(records, self.iq[self.count:self.count + n])
+        self.count += n
+
+    def result(self):
+        # returns a (records, N) complex array in sample codes
+        return self.iq[:self.count].view(np.complex128)
+
+class iq_demodulator(multitone_demodulator):
+    # reduces every record to one complex IQ point at an IF frequency
+    # if_freq = float: in Hz
+    # see multitone_demodulator for the other arguments
+
+    def __init__(self, if_freq, window_start = 0, window_length = None,
+                 channel = 'A'):
+        super().__init__([if_freq], window_start, window_length, channel)
+
+    def result(self):
+        # returns a (records,) complex array in sample codes
+        return super().result()[:, 0]
+
+class psd_accumulator:
+    # Welch power spectral density, averaged over every segment of every
+    # buffer; only the running sums are kept
+    # segment_length = int: samples per FFT segment
+    # overlap = float: fraction of a segment shared with the next one
+    # continuous = bool: False cuts segments out of each record separately,
+    #   True treats the buffers as one gapless stream (acquire_continuous)
+    #   and carries the tail of each buffer over into the next segment
+    # full_scale = float or list of one float per acquired channel: input
+    #   range in volts, e.g. 2.0 for INPUT_RANGE_PM_2_V, gives the PSD in
+    #   V^2/Hz instead of codes^2/Hz
+
+    def __init__(self, segment_length, overlap = 0.5, continuous = False,
+                 full_scale = None):
+        self.segment_length = segment_length
+        self.step = max(1, int(round(segment_length * (1 - overlap))))
+        self.continuous = continuous
+        self.full_scale = full_scale
+
+    def start(self, info):
+        n = self.segment_length
+        if not self.continuous and n > info.samplesPerRecord:
+            raise ValueError('Segment is longer than the record')
+        self.channelCount = info.channelCount
+        self.zero_code = info.zero_code
+        self.samplesPerSec = info.samplesPerSec
+        self.window = np.hanning(n)
+        self.window_power = (self.window**2).sum()
+        # volts per code of each channel, applied in result()
+        self.volts_per_code = np.ones(info.channelCount)
+        if self.full_scale is not None:
+            full_scale = np.broadcast_to(np.asarray(self.full_scale, float),
+                                         (info.channelCount,))
+            self.volts_per_code = full_scale / \
+                (((1 << (8 * info.bytesPerSample)) - 1) / 2)
+        self.freqs = np.fft.rfftfreq(n, 1 / info.samplesPerSec)
+        self.power = np.zeros((info.channelCount, len(self.freqs)))
+        self.cross = np.zeros(len(self.freqs), dtype = np.complex128)
+        self.segments = 0
+        if self.continuous:
+            samplesPerBuffer = info.recordsPerBuffer * info.samplesPerRecord
+            self.pending = np.empty((info.channelCount, n + samplesPerBuffer))
+            self.n_pending = 0
+            segs_per_buffer = samplesPerBuffer // self.step + 1
+        else:
+            segs_per_buffer = info.recordsPerBuffer * \
+                ((info.samplesPerRecord - n) // self.step + 1)
+        self.work = np.empty((segs_per_buffer, info.channelCount, n))
+
+    def _accumulate(self, segments):
+        # segments = (segments, channels, samples) view
+        k = segments.shape[0]
+        work = self.work[:k]
+        work[...] = segments
+        work -= self.zero_code
+        work *= self.window
+        spectra = np.fft.rfft(work, axis = -1)
+        self.power += (spectra.real**2 + spectra.imag**2).sum(axis = 0)
+        if self.channelCount == 2:
+            self.cross += (spectra[:, 0] * spectra[:, 1].conj()).sum(axis = 0)
+        self.segments += k
+
+    def process(self, records):
+        n = self.segment_length
+        if not self.continuous:
+            # (records, segments, channels, samples) strided view
+            segments = np.lib.stride_tricks.sliding_window_view(
+                records, n, axis = 1)[:, ::self.step]
+            self._accumulate(segments.reshape(-1, self.channelCount, n))
+            return
+        # append the buffer to the samples left over from the last one
+        flat = records.reshape(-1, self.channelCount)
+        end = self.n_pending + flat.shape[0]
+        self.pending[:, self.n_pending:end] = flat.T
+        if end >= n:
+            k = (end - n) // self.step + 1
+            segments = np.lib.stride_tricks.sliding_window_view(
+                self.pending[:, :end], n, axis = 1)[:, :k * self.step:self.step]
+            self._accumulate(np.moveaxis(segments, 1, 0))
+            used = k * self.step
+            self.pending[:, :end - used] = self.pending[:, used:end]
+            end -= used
+        self.n_pending = end
+
+    def result(self):
+        # returns (freqs, psd) with psd shaped (frequencies, channels), plus
+        # the A.B* cross spectral density for two-channel acquisitions
+        scale = 1 / (self.samplesPerSec * self.window_power *
+                     max(self.segments, 1))
+        # one-sided: double everything but DC and Nyquist
+        onesided = np.full(len(self.freqs), 2.0)
+        onesided[0] = 1
+        if self.segment_length % 2 == 0:
+            onesided[-1] = 1
+        psd = (self.power * self.volts_per_code[:, None]**2 *
+               scale * onesided).T
+        if self.channelCount == 2:
+            return self.freqs, psd, self.cross * scale * onesided * \
+                self.volts_per_code[0] * self.volts_per_code[1]
+        return self.freqs, psd
+
+class cross_correlator:
+    # averaged A/B cross-correlation <A(t + lag) B(t)> for two-channel
+    # acquisitions, computed with FFTs. Cross spectra are summed in the
+    # frequency domain and transformed back once in result(), so no raw
+    # data is kept
+    # max_lag = float: in seconds, lags from -max_lag to max_lag are kept
+    # continuous = bool: False correlates each record on its own, True
+    #   treats the buffers as one gapless stream (acquire_continuous) and
+    #   includes the pairs that straddle buffer boundaries
+    # normalize = bool: divide by <A><B>, for g2 from power detectors
+
+    def __init__(self, max_lag, continuous = False, normalize = False):
+        self.max_lag = max_lag
+        self.continuous = continuous
+        self.normalize = normalize
+
+    def start(self, info):
+        if info.channelCount != 2:
+            raise ValueError('Cross-correlation needs channel_str = \'AB\'')
+        self.samplesPerSec = info.samplesPerSec
+        self.zero_code = info.zero_code
+        self.lag = int(round(self.max_lag * info.samplesPerSec))
+        if self.continuous:
+            # the last lag samples of each buffer are carried over
+            length = self.lag + info.recordsPerBuffer * info.samplesPerRecord
+            blocks = 1
+        else:
+            if self.lag >= info.samplesPerRecord:
+                raise ValueError('max_lag is longer than the record')
+            length = info.samplesPerRecord
+            blocks = info.recordsPerBuffer
+        self.length = length
+        # zero padding keeps the circular correlation from wrapping over the
+        # lags of interest; the padding of the workspace is never written
+        self.nfft = 1 << int(math.ceil(math.log2(length + self.lag)))
+        self.work = np.zeros((blocks, 2, self.nfft))
+        self.spectrum = np.zeros(self.nfft // 2 + 1, dtype = np.complex128)
+        self.sums = np.zeros(2)
+        self.samples = 0
+        self.records = 0
+        if self.continuous:
+            self.tail = np.zeros((2, self.nfft))
+
+    def _cross_spectrum(self, work):
+        spectra = np.fft.rfft(work, axis = -1)
+        return (spectra[:, 0] * spectra[:, 1].conj()).sum(axis = 0)
+
+    def process(self, records):
+        if not self.continuous:
+            n = records.shape[0]
+            work = self.work[:n, :, :self.length]
+            work[...] = np.moveaxis(records, 2, 1)
+            work -= self.zero_code
+            self.sums += work.sum(axis = (0, 2))
+            self.spectrum += self._cross_spectrum(self.work[:n])
+            self.records += n
+            self.samples += n * self.length
+            return
+        # pairs with both samples in the carried-over tail were already
+        # counted with the previous buffer, so subtract them
+        flat = records.reshape(-1, 2).T
+        work = self.work[0]
+        work[:, :self.lag] = self.tail[:, :self.lag]
+        work[:, self.lag:self.length] = flat
+        work[:, self.lag:self.length] -= self.zero_code
+        self.sums += work[:, self.lag:self.length].sum(axis = 1)
+        self.spectrum += self._cross_spectrum(self.work)
+        self.spectrum -= self._cross_spectrum(self.tail[None])
+        self.tail[:, :self.lag] = work[:, self.length - self.lag:self.length]
+        self.samples += flat.shape[1]
+
+    def result(self):
+        # returns (lags in seconds, correlation) in codes^2 relative to 0V,
+        # or normalized by <A><B>
+        r = np.fft.irfft(self.spectrum, self.nfft)
+        lags = np.arange(-self.lag, self.lag + 1)
+        corr = r[lags % self.nfft]
+        # number of pairs that went into each lag
+        if self.continuous:
+            pairs = self.samples - np.abs(lags)
+        else:
+            pairs = self.records * (self.length - np.abs(lags))
+        corr = corr / np.maximum(pairs, 1)
+        if self.normalize:
+            means = self.sums / max(self.samples, 1)
+            corr = corr / (means[0] * means[1])
+        return lags / self.samplesPerSec, corr
+
+class iq_histogram:
+    # 2-D histogram of demodulated single-shot IQ points, for readout
+    # calibration. Only the counts and running moments are kept, and they
+    # keep accumulating over every acquisition the histogram is used in
+    # until reset() is called
+    # demodulator = iq_demodulator: sets the IF frequency and window
+    # i_range, q_range = (min, max): extent of the grid in sample codes
+    # bins = int or (int, int): number of bins along I and Q
+
+    def __init__(self, demodulator, i_range, q_range, bins = 100):
+        self.demodulator = demodulator
+        if np.isscalar(bins):
+            bins = (bins, bins)
+        self.bins = tuple(bins)
+        self.i_edges = np.linspace(i_range[0], i_range[1], self.bins[0] + 1)
+        self.q_edges = np.linspace(q_range[0], q_range[1], self.bins[1] + 1)
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(self.bins, dtype = np.int64)
+        self.outside = 0 # points that fell outside the grid
+        # running moments of (I, Q), merged buffer by buffer
+        self.n = 0
+        self.mean = np.zeros(2)
+        self.m2 = np.zeros((2, 2))
+
+    def start(self, info):
+        self.demodulator.prepare(info)
+        self.iq = np.empty((info.recordsPerBuffer, 2))
+
+    def add(self, iq):
+        # bins a (points, 2) float array of I, Q
+        n = iq.shape[0]
+        if n == 0:
+            return
+        i_bin = np.floor((iq[:, 0] - self.i_edges[0]) /
+                         (self.i_edges[1] - self.i_edges[0]))
+        q_bin = np.floor((iq[:, 1] - self.q_edges[0]) /
+                         (self.q_edges[1] - self.q_edges[0]))
+        inside = (i_bin >= 0) & (i_bin < self.bins[0]) & \
+                 (q_bin >= 0) & (q_bin < self.bins[1])
+        # flattened bin index, so one bincount fills the whole grid
+        np.multiply(i_bin, self.bins[1], out = i_bin)
+        np.add(i_bin, q_bin, out = i_bin)
+        self.counts += np.bincount(i_bin[inside].astype(np.intp),
+                                   minlength = self.counts.size).reshape(
+                                       self.bins)
+        self.outside += n - int(np.count_nonzero(inside))
+        self._merge_moments(n, iq.mean(axis = 0),
+                            np.cov(iq.T, bias = True) * n)
+
+    def _merge_moments(self, n, mean, m2):
+        # Chan et al. pairwise update of count, mean and scatter matrix
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * self.n * n / total
+        self.n = total
+
+    def merge(self, other):
+        # adds the counts and moments of another histogram on the same grid
+        if other.bins != self.bins or \
+                not np.array_equal(other.i_edges, self.i_edges) or \
+                not np.array_equal(other.q_edges, self.q_edges):
+            raise ValueError('Histograms have different grids')
+        self.counts += other.counts
+        self.outside += other.outside
+        if other.n:
+            self._merge_moments(other.n, other.mean, other.m2)
+
+    def process(self, records):
+        n = records.shape[0]
+        self.demodulator.demodulate(records, self.iq[:n])
+        self.add(self.iq[:n])
+
+    def result(self):
+        # returns (counts, i_edges, q_edges, moments) with moments a dict of
+        # the number of points, the mean as a complex number and the 2x2
+        # covariance of (I, Q)
+        moments = {'count': self.n,
+                   'mean': complex(self.mean[0], self.mean[1]),
+                   'cov': self.m2 / max(self.n, 1)}
+        return self.counts, self.i_edges, self.q_edges, moments
+
+class convergence_monitor:
+    # demodulates every record and stops the acquisition once the standard
+    # error of the mean of a per-record quantity drops below a target.
+    # Running statistics are merged buffer by buffer (Welford/Chan), no
+    # shots are kept
+    # demodulator = iq_demodulator
+    # target_error = float: standard error to reach, in the quantity's units
+    # quantity = 'I', 'Q', 'population' or a function mapping a complex
+    #   array of shots to a real array
+    #   'population' is the fraction of shots with I > threshold, its
+    #   standard error is sqrt(p(1 - p)/n)
+    # threshold = float: in sample codes, for 'population'
+    # min_records = int: never stop before this many records
+
+    def __init__(self, demodulator, target_error, quantity = 'I',
+                 threshold = None, min_records = 100):
+        self.demodulator = demodulator
+        self.target_error = target_error
+        self.quantity = quantity
+        self.threshold = threshold
+        self.min_records = min_records
+        if quantity == 'population' and threshold is None:
+            raise ValueError('quantity = \'population\' needs a threshold')
+
+    def start(self, info):
+        self.demodulator.prepare(info)
+        self.iq = np.empty((info.recordsPerBuffer, 2))
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.done = False
+
+    def values(self, iq):
+        # iq = (records, 2) float array of I, Q
+        if self.quantity == 'I':
+            return iq[:, 0]
+        if self.quantity == 'Q':
+            return iq[:, 1]
+        if self.quantity == 'population':
+            return (iq[:, 0] > self.threshold).astype(np.float64)
+        return self.quantity(iq.view(np.complex128)[:, 0])
+
+    def error(self):
+        # standard error of the mean so far
+        if self.n < 2:
+            return math.inf
+        return math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+    def process(self, records):
+        k = records.shape[0]
+        self.demodulator.demodulate(records, self.iq[:k])
+        x = self.values(self.iq[:k])
+        # merge the buffer's mean and sum of squares into the running ones
+        mean = x.mean()
+        m2 = ((x - mean)**2).sum()
+        total = self.n + k
+        delta = mean - self.mean
+        self.mean += delta * k / total
+        self.m2 += m2 + delta**2 * self.n * k / total
+        self.n = total
+        if self.n >= self.min_records and self.error() <= self.target_error:
+            self.done = True
+
+    def result(self):
+        # returns (mean, standard error, number of records used)
+        return self.mean, self.error(), self.n
+
+def lowpass_taps(num_taps, cutoff):
+    # windowed-sinc (Hamming) lowpass FIR with unity DC gain
+    # cutoff = float: as a fraction of the sample rate, below 0.5
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+    return taps / taps.sum()
+
+class decimating_filter:
+    # streaming decimating FIR filter: lowpass and keep every decimation-th
+    # sample, optionally after mixing down to complex baseband
+    # Only the retained outputs are computed, one dot product with the taps
+    # per output sample, which costs the same as a polyphase filter bank
+    # decimation = int
+    # taps = array of FIR taps, defaults to lowpass_taps(num_taps, cutoff)
+    # num_taps = int: defaults to 8 * decimation + 1
+    # cutoff = float: in Hz, defaults to 80% of the output Nyquist frequency
+    # lo_freq = float: in Hz, mix each channel with exp(-2 pi i lo_freq t)
+    #   first, output is then complex with |z| the amplitude of the tone
+    # continuous = bool: False filters every record on its own (NPT),
+    #   True treats the buffers as one gapless stream (acquire_continuous)
+    #   and carries the filter state over buffer boundaries
+    # dtype = np.float32 or np.float64 (complex64/128 with lo_freq)
+    # For continuous streams the output goes to one of, so memory stays
+    # bounded however long the stream runs:
+    # sink = function called with every block of new (samples, channels)
+    #   outputs, e.g. lambda block: block.tofile(f). The block is only
+    #   valid during the call
+    # out_samples = int: preallocated output; the filter is done (and the
+    #   acquisition stops) once it is full
+    # otherwise the output is preallocated for max_buffers of the stream
+
+    def __init__(self, decimation, taps = None, num_taps = None,
+                 cutoff = None, lo_freq = None, continuous = False,
+                 dtype = np.float32, sink = None, out_samples = None):
+        self.decimation = decimation
+        self.taps = taps
+        self.num_taps = num_taps or 8 * decimation + 1
+        self.cutoff = cutoff
+        self.lo_freq = lo_freq
+        self.continuous = continuous
+        self.dtype = np.dtype(dtype)
+        self.sink = sink
+        self.out_samples = out_samples
+        if lo_freq is not None:
+            self.dtype = np.result_type(self.dtype, np.complex64)
+
+    def start(self, info):
+        d = self.decimation
+        self.samplesPerSec = info.samplesPerSec / d
+        if self.taps is None:
+            cutoff = self.cutoff or 0.8 * self.samplesPerSec / 2
+            taps = lowpass_taps(self.num_taps, cutoff / info.samplesPerSec)
+        else:
+            taps = np.asarray(self.taps, dtype = np.float64)
+        # reversed, so a window of samples . taps is the convolution
+        self.kernel = taps[::-1].copy()
+        if self.lo_freq is not None:
+            self.kernel *= 2
+        n_taps = len(self.kernel)
+        self.zero_code = info.zero_code
+        self.channelCount = info.channelCount
+        work_type = np.complex128 if self.lo_freq is not None else np.float64
+        if self.continuous:
+            block = info.recordsPerBuffer * info.samplesPerRecord
+            self.pending = np.zeros((info.channelCount, n_taps - 1 + block),
+                                    dtype = work_type)
+            # start with a full window of zeros so the first output lines
+            # up with the first sample
+            self.n_pending = n_taps - 1
+            # outputs of one buffer, computed in place
+            max_outputs = (block - 1) // d + 1
+            self.block = np.empty((info.channelCount, max_outputs),
+                                  dtype = work_type)
+            self.count = 0
+            self.done = False
+            if self.sink is not None:
+                self.block_out = np.empty((max_outputs, info.channelCount),
+                                          dtype = self.dtype)
+            else:
+                out_samples = self.out_samples
+                if out_samples is None:
+                    if info.buffersPerAcquisition is None:
+                        raise ValueError('An unbounded stream needs a sink '
+                                         'or out_samples')
+                    out_samples = info.buffersPerAcquisition * \
+                        (block // d + 1)
+                self.out = np.empty((out_samples, info.channelCount),
+                                    dtype = self.dtype)
+        else:
+            if n_taps > info.samplesPerRecord:
+                raise ValueError('Filter is longer than the record')
+            block = info.samplesPerRecord
+            if info.buffersPerAcquisition is None:
+                raise ValueError('An unbounded stream needs max_buffers or '
+                                 'continuous = True')
+            self.outputs = (block - n_taps) // d + 1
+            self.work = np.empty((info.recordsPerBuffer, info.channelCount,
+                                  block), dtype = work_type)
+            self.out = np.empty((info.buffersPerAcquisition *
+                                 info.recordsPerBuffer, self.outputs,
+                                 info.channelCount), dtype = self.dtype)
+            self.count = 0
+        if self.lo_freq is not None:
+            # local oscillator for one block, the phase relative to the
+            # trigger for records or advanced by a scalar between buffers
+            t = (np.arange(block) - (0 if self.continuous
+                                     else info.preTriggerSamples)) / \
+                info.samplesPerSec
+            self.lo = np.exp(-2j * np.pi * self.lo_freq * t)
+            self.lo_step = np.exp(-2j * np.pi * self.lo_freq * block /
+                                  info.samplesPerSec)
+            self.lo_phase = 1.0 + 0j
+
+    def process(self, records):
+        d = self.decimation
+        n_taps = len(self.kernel)
+        if not self.continuous:
+            n = records.shape[0]
+            work = self.work[:n]
+            work[...] = np.moveaxis(records, 2, 1)
+            work -= self.zero_code
+            if self.lo_freq is not None:
+                work *= self.lo
+            windows = np.lib.stride_tricks.sliding_window_view(
+                work, n_taps, axis = 2)[:, :, ::d][:, :, :self.outputs]
+            out = self.out[self.count:self.count + n]
+            np.moveaxis(out, 2, 1)[...] = windows @ self.kernel
+            self.count += n
+            return
+        # append the buffer to the filter state and emit every output whose
+        # window is complete
+        flat = records.reshape(-1, self.channelCount).T
+        start = self.n_pending
+        end = start + flat.shape[1]
+        new = self.pending[:, start:end]
+        new[...] = flat
+        new -= self.zero_code
+        if self.lo_freq is not None:
+            new *= self.lo[:flat.shape[1]]
+            new *= self.lo_phase
+            self.lo_phase *= self.lo_step
+        if end >= n_taps:
+            k = (end - n_taps) // d + 1
+            windows = np.lib.stride_tricks.sliding_window_view(
+                self.pending[:, :end], n_taps, axis = 1)[:, :k * d:d]
+            outputs = self.block[:, :k]
+            np.matmul(windows, self.kernel, out = outputs)
+            self._emit(outputs.T)
+            used = k * d
+            self.pending[:, :end - used] = self.pending[:, used:end]
+            end -= used
+        self.n_pending = end
+
+    def _emit(self, outputs):
+        # outputs = (samples, channels) new outputs of a continuous stream
+        k = outputs.shape[0]
+        if self.sink is not None:
+            block = self.block_out[:k]
+            block[...] = outputs
+            self.sink(block)
+            self.count += k
+            return
+        k = min(k, len(self.out) - self.count)
+        self.out[self.count:self.count + k] = outputs[:k]
+        self.count += k
+        if self.count == len(self.out):
+            self.done = True
+
+    def result(self):
+        # returns the decimated data relative to 0V in sample codes:
+        # (records, samples, channels) for records, or (samples, channels)
+        # for a continuous stream. The output rate is self.samplesPerSec
+        # With a sink, returns the number of samples handed to it
+        if self.continuous and self.sink is not None:
+            return self.count
+        return self.out[:self.count]
+
+class record_selector:
+    # predicate for acquire_NPT(select = ...): keeps the records whose
+    # integrated signal in a window passes a threshold, e.g. heralded shots
+    # window_start = float: in seconds, relative to the start of the record
+    # window_length = float: in seconds, defaults to the rest of the record
+    # threshold = float: in sample codes
+    # channel = str: 'A' or 'B'
+    # if_freq = float: in Hz. If given the signal is the demodulated
+    #   amplitude |IQ| at if_freq, otherwise the mean of the codes relative
+    #   to 0V over the window
+    # above = bool: keep records above the threshold, or below it
+    # Any function taking (records, samples, channels) codes and returning
+    # a boolean array over records works as a predicate too
+
+    def __init__(self, window_start, window_length, threshold,
+                 channel = 'A', if_freq = None, above = True):
+        self.window_start = window_start
+        self.window_length = window_length
+        self.threshold = threshold
+        self.channel = channel
+        self.if_freq = if_freq
+        self.above = above
+
+    def start(self, info):
+        self.channel_ind = info.channel_str.index(self.channel)
+        self.zero_code = info.zero_code
+        if self.if_freq is not None:
+            self.demodulator = iq_demodulator(self.if_freq, self.window_start,
+                                              self.window_length,
+                                              self.channel)
+            self.demodulator.prepare(info)
+            self.iq = np.empty((info.recordsPerBuffer, 2))
+            return
+        self.start_ind = int(round(self.window_start * info.samplesPerSec))
+        if self.window_length is None:
+            self.stop_ind = info.samplesPerRecord
+        else:
+            self.stop_ind = self.start_ind + \
+                int(round(self.window_length * info.samplesPerSec))
+        if not 0 <= self.start_ind < self.stop_ind <= info.samplesPerRecord:
+            raise ValueError('Herald window does not fit in the record')
+
+    def signal(self, records):
+        # returns the per-record signal compared with the threshold
+        if self.if_freq is not None:
+            iq = self.iq[:records.shape[0]]
+            self.demodulator.demodulate(records, iq)
+            return np.hypot(iq[:, 0], iq[:, 1])
+        window = records[:, self.start_ind:self.stop_ind, self.channel_ind]
+        return window.mean(axis = 1) - self.zero_code
+
+    def __call__(self, records):
+        if self.above:
+            return self.signal(records) > self.threshold
+        return self.signal(records) < self.threshold
+
+# shared memory slots attached in a worker process of process_pool_processor
+_worker_slots = []
+
+def _attach_slots(names, shape, dtype):
+    # process pool initializer: maps every slot of the ring once per worker
+    for name in names:
+        shm = shared_memory.SharedMemory(name = name)
+        _worker_slots.append((shm, np.ndarray(shape, dtype = dtype,
+                                              buffer = shm.buf)))
+
+def _process_slot(function, slot, n):
+    return function(_worker_slots[slot][1][:n])
+
+def _worker_ready():
+    # no-op task used to start the pool's processes before the acquisition
+    return os.getpid()
+
+class process_pool_processor:
+    # offloads CPU-heavy per-buffer analysis to a pool of processes, which
+    # the GIL keeps threads from doing. Each buffer is copied into the next
+    # slot of a ring of shared memory blocks and only the slot index is sent
+    # to a worker, so the DMA buffer can be reposted right away
+    # function = picklable module-level function taking a
+    #   (records, samples, channels) array of sample codes; the array is
+    #   only valid during the call, so return what you need from it
+    # workers = int: number of processes, defaults to the number of CPUs
+    # slots = int: size of the ring; when every slot is still being
+    #   analysed, the DMA loop waits for the oldest one
+    # NOTE: on Windows, scripts using this must be guarded by
+    #   if __name__ == '__main__':
+
+    def __init__(self, function, workers = None, slots = None):
+        self.function = function
+        self.workers = workers or os.cpu_count()
+        self.slots = slots or 2 * self.workers
+        self.pool = None
+        self.shms = []
+
+    def start(self, info):
+        self.close()
+        shape = (info.recordsPerBuffer, info.samplesPerRecord,
+                 info.channelCount)
+        nbytes = int(np.prod(shape)) * np.dtype(info.sample_dtype).itemsize
+        self.shms = [shared_memory.SharedMemory(create = True, size = nbytes)
+                     for i in range(self.slots)]
+        self.arrays = [np.ndarray(shape, dtype = info.sample_dtype,
+                                  buffer = shm.buf) for shm in self.shms]
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer = _attach_slots,
+            initargs = ([shm.name for shm in self.shms], shape,
+                        info.sample_dtype))
+        # the pool only spawns processes when tasks are submitted; spawning
+        # them inside the DMA loop stalls the first buffers, so start (and
+        # attach) every worker now
+        warmup = [self.pool.submit(_worker_ready) for i in range(self.workers)]
+        for future in warmup:
+            future.result()
+        self.futures = []
+        # slot -> future still reading it
+        self.busy = [None] * self.slots
+
+    def process(self, records):
+        slot = len(self.futures) % self.slots
+        if self.busy[slot] is not None:
+            self.busy[slot].result()
+        n = records.shape[0]
+        self.arrays[slot][:n] = records
+        future = self.pool.submit(_process_slot, self.function, slot, n)
+        self.busy[slot] = future
+        self.futures.append(future)
+
+    def result(self):
+        # returns the per-buffer results in acquisition order
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.close()
+
+    def close(self):
+        # shuts the pool down once the queued buffers are analysed, and frees
+        # the shared memory. Finished futures keep their results
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.arrays = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+
+class ats_buffer_writer:
+    # background writer for acquire_NPT
+    # the DMA loop only hands filled buffers to a bounded queue; this thread
+    # writes them to disk and posts them back to the board once the write is
+    # done, so a disk stall no longer holds up postAsyncBuffer
+    # board = ats.Board
+    # dataFile = open binary file object
+    # queue_size = int: max number of filled buffers waiting to be written
+    # drop_when_full = bool: if the queue is full, repost the buffer without
+    #   writing it instead of blocking the DMA loop. The indices of dropped
+    #   buffers are kept in dropped_buffers, the file then has gaps
+
+    def __init__(self, board, dataFile, queue_size, drop_when_full = False):
+        self.board = board
+        self.dataFile = dataFile
+        self.queue_size = queue_size
+        self.drop_when_full = drop_when_full
+        self.queue = queue.Queue(maxsize = queue_size)
+        # buffers have to be waited on in the order they were posted, and
+        # both this thread and the DMA loop post buffers, so keep the posting
+        # order here
+        self.posted = collections.deque()
+        self.posted_cv = threading.Condition()
+        self.buffers_written = 0
+        self.buffers_dropped = 0
+        self.dropped_buffers = []
+        self.max_queue_depth = 0
+        self.error = None
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def post(self, buffer):
+        # posts buffer to the board and records it as the newest posted buffer
+        with self.posted_cv:
+            self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self.posted.append(buffer)
+            self.posted_cv.notify()
+
+    def next_buffer(self, timeout_sec = 5):
+        # returns the oldest posted buffer, which is the next one the board
+        # will fill. Blocks while every buffer is waiting on the writer
+        with self.posted_cv:
+            if not self.posted_cv.wait_for(lambda: self.posted, timeout_sec):
+                raise RuntimeError('Writer thread did not return a buffer '
+                                   'within %g sec' % timeout_sec)
+            return self.posted.popleft()
+
+    def submit(self, buffer, data = None, index = None):
+        # hands a filled buffer to the writer
+        # data = array to write instead of the buffer, e.g. a copy of the
+        #   selected records; with buffer = None nothing is reposted
+        # index = int: number of the buffer in the acquisition, recorded if
+        #   it is dropped
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait((buffer, data))
+            except queue.Full:
+                self.buffers_dropped += 1
+                self.dropped_buffers.append(index)
+                if buffer is not None:
+                    self.post(buffer)
+                return
+        else:
+            self.queue.put((buffer, data))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def close(self):
+        # waits for every queued buffer to be written
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        print("Writer: %d buffers written, %d dropped, max queue depth %d/%d" %
+              (self.buffers_written, self.buffers_dropped,
+               self.max_queue_depth, self.queue_size))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            buffer, data = item
+            if data is None:
+                data = buffer.buffer
+            if self.error is None:
+                try:
+                    data.tofile(self.dataFile)
+                    self.buffers_written += 1
+                except Exception as e:
+                    # keep reposting so the board doesn't stall, the error
+                    # is raised from close()
+                    self.error = e
+            if buffer is not None:
+                self.post(buffer)
+
+class acquisition_stats:
+    # per-buffer timing of the DMA loop, measured with time.perf_counter
+    # timings = (buffers, 4) array of the time spent in each stage of the
+    #   loop for every buffer, in seconds, see STAGES
+    # completed = (buffers,) array of the time each buffer came back from
+    #   waitAsyncBufferComplete, relative to startCapture
+    # near_overflow_sec = float: a wait shorter than this means the buffer
+    #   was already full when the loop got to it, i.e. the board was ahead
+
+    STAGES = ('wait', 'process', 'write', 'repost')
+
+    def __init__(self, timings, completed, bytesPerBuffer,
+                 near_overflow_sec = 10e-6):
+        self.timings = timings
+        self.completed = completed
+        self.bytesPerBuffer = bytesPerBuffer
+        self.near_overflow_sec = near_overflow_sec
+        self.buffers = len(timings)
+
+    def stage(self, name):
+        # returns the per-buffer times of one stage
+        return self.timings[:, self.STAGES.index(name)]
+
+    def busy(self):
+        # time per buffer spent outside waitAsyncBufferComplete
+        return self.timings[:, 1:].sum(axis = 1)
+
+    def near_overflow_count(self):
+        # buffers that were already full when the loop started waiting. A
+        # run of these means processing is not keeping up with the board
+        # and the remaining posted buffers are the only headroom left
+        return int(np.count_nonzero(self.stage('wait') <
+                                    self.near_overflow_sec))
+
+    def percentiles(self, q = (50, 90, 99, 100)):
+        # returns {stage: array of percentiles in seconds}
+        if self.buffers == 0:
+            return {name: np.zeros(len(q)) for name in self.STAGES}
+        return {name: np.percentile(self.stage(name), q)
+                for name in self.STAGES}
+
+    def histogram(self, name, bins = 50):
+        # returns (counts, bin edges in seconds) for one stage
+        return np.histogram(self.stage(name), bins = bins)
+
+    def throughput(self):
+        # bytes per second between the first and last completed buffer
+        if self.buffers < 2 or self.completed[-1] <= self.completed[0]:
+            return 0.0
+        return (self.buffers - 1) * self.bytesPerBuffer / \
+            (self.completed[-1] - self.completed[0])
+
+    def report(self):
+        q = (50, 90, 99, 100)
+        print('Per-buffer times in us (p50, p90, p99, max):')
+        for name, p in self.percentiles(q).items():
+            print('    %-8s' % name + ' '.join('%10.1f' % (1e6 * x)
+                                               for x in p))
+        print('Near-overflow buffers: %d of %d' %
+              (self.near_overflow_count(), self.buffers))
+
+    def save(self, filename, bins = 50):
+        # writes a JSON summary (percentiles, histograms, near-overflow
+        # count) next to the data
+        summary = {'buffers': self.buffers,
+                   'bytesPerBuffer': self.bytesPerBuffer,
+                   'throughput_bytes_per_sec': self.throughput(),
+                   'near_overflow_sec': self.near_overflow_sec,
+                   'near_overflow_count': self.near_overflow_count(),
+                   'percentiles': {name: p.tolist() for name, p in
+                                   self.percentiles((50, 90, 99, 100)).items()},
+                   'histograms': {}}
+        if self.buffers:
+            for name in self.STAGES:
+                counts, edges = self.histogram(name, bins)
+                summary['histograms'][name] = {'counts': counts.tolist(),
+                                               'edges': edges.tolist()}
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent = 1)
+
+class dma_buffer_pool:
+    # keeps page-locked DMA buffers alive between acquisitions, keyed by
+    # sample type and buffer size, so repeated acquisitions with the same
+    # shape don't reallocate them
+    # board = ats.Board
+    # max_bytes = int: page-locked memory the pool may keep. When a new shape
+    #   goes over it, the least recently used shapes are freed
+
+    def __init__(self, board, max_bytes = 1024**3):
+        self.board = board
+        self.max_bytes = max_bytes
+        # least recently used first
+        self.buffers = collections.OrderedDict()
+
+    def get(self, sample_type, bytesPerBuffer, buffer_count):
+        # returns a list of buffer_count buffers of the given size,
+        # allocating only the ones the pool doesn't have yet
+        key = (sample_type, bytesPerBuffer)
+        pool = self.buffers.setdefault(key, [])
+        self.buffers.move_to_end(key)
+        if len(pool) < buffer_count:
+            # make room first, so old and new shapes are never both pinned
+            self.evict(self.max_bytes - bytesPerBuffer *
+                       (buffer_count - len(pool)), keep = key)
+        while len(pool) < buffer_count:
+            pool.append(ats.DMABuffer(self.board.handle, sample_type,
+                                      bytesPerBuffer))
+        return pool[:buffer_count]
+
+    def nbytes(self):
+        # page-locked memory held by the pool
+        return sum(size * len(pool)
+                   for (sample_type, size), pool in self.buffers.items())
+
+    def evict(self, max_bytes, keep = None):
+        # frees the least recently used shapes, except keep, until the pool
+        # holds at most max_bytes
+        freed = 0
+        for key in list(self.buffers):
+            if self.nbytes() <= max_bytes:
+                break
+            if key == keep:
+                continue
+            freed += key[1] * len(self.buffers[key])
+            self._free(self.buffers.pop(key))
+        if freed:
+            print("Freed %.1f MB of DMA buffers, pool holds %.1f MB" %
+                  (freed / 1e6, self.nbytes() / 1e6))
+
+    def _free(self, pool):
+        for buffer in pool:
+            if hasattr(buffer, '__exit__'):
+                buffer.__exit__()
+
+    def clear(self):
+        # releases every buffer
+        for pool in self.buffers.values():
+            self._free(pool)
+        self.buffers = collections.OrderedDict()
+
+class buffer_planner:
+    # picks recordsPerBuffer, buffersPerAcquisition and buffer_count for
+    # acquire_NPT. Buffers are sized in the efficient DMA range, large enough
+    # that the fixed per-buffer cost of the DMA loop stays a small fraction of
+    # the buffer period, and there are enough of them to ride out host stalls
+    # within the memory budget
+    # min_buffer_bytes, max_buffer_bytes = int: efficient DMA buffer sizes
+    # memory_budget_bytes = int: page-locked memory for all buffers
+    # overhead_sec = float: fixed cost per buffer, see calibrate
+    # per_byte_sec = float: processing cost per byte, see calibrate
+    # max_load = float: max fraction of the buffer period spent processing
+    # stall_sec = float: host stall the posted buffers should cover
+    # Plans are cached by geometry, so repeated sweeps reuse them:
+    #   plan = planner.plan(record_length, 'AB', 10**6, 100e3)
+    #   digitizer.acquire_NPT(record_length = record_length, **plan)
+
+    def __init__(self, min_buffer_bytes = 1024**2,
+                 max_buffer_bytes = 16 * 1024**2,
+                 memory_budget_bytes = 256 * 1024**2,
+                 overhead_sec = 100e-6, per_byte_sec = 0.0,
+                 max_load = 0.5, stall_sec = 0.1):
+        self.min_buffer_bytes = min_buffer_bytes
+        self.max_buffer_bytes = max_buffer_bytes
+        self.memory_budget_bytes = memory_budget_bytes
+        self.overhead_sec = overhead_sec
+        self.per_byte_sec = per_byte_sec
+        self.max_load = max_load
+        self.stall_sec = stall_sec
+        self.plans = {}
+        self.last_plan = None
+        self.last_key = None
+
+    def calibrate(self, digitizer, record_length = 10**-6, channel_str = 'A',
+                  buffersPerAcquisition = 32, **acquire_kwargs):
+        # measures overhead_sec and per_byte_sec with two short acquisitions,
+        # one with single-record buffers and one with min_buffer_bytes
+        # buffers. Pass the processing the real acquisitions use in
+        # acquire_kwargs (e.g. processor, or save_data and filename)
+        acquire_kwargs.setdefault('save_data', False)
+        bytesPerRecord = self.bytes_per_record(record_length, channel_str,
+                                               digitizer.bytes_per_sample(),
+                                               0, digitizer.samples_per_sec())
+        points = []
+        for recordsPerBuffer in (1, max(self.min_buffer_bytes //
+                                        bytesPerRecord, 2)):
+            digitizer.acquire_NPT(record_length = record_length,
+                                  recordsPerBuffer = recordsPerBuffer,
+                                  buffersPerAcquisition = buffersPerAcquisition,
+                                  buffer_count = min(buffersPerAcquisition, 8),
+                                  channel_str = channel_str,
+                                  **acquire_kwargs)
+            busy = digitizer.last_stats.busy()
+            points.append((recordsPerBuffer * bytesPerRecord,
+                           np.median(busy[1:]))) # the first includes startup
+        (bytes0, busy0), (bytes1, busy1) = points
+        self.per_byte_sec = max((busy1 - busy0) / (bytes1 - bytes0), 0.0)
+        self.overhead_sec = max(busy0 - self.per_byte_sec * bytes0, 0.0)
+        # earlier plans used the old costs
+        self.plans = {}
+        print("Per-buffer overhead %.1f us, %.3f ns/byte" %
+              (1e6 * self.overhead_sec, 1e9 * self.per_byte_sec))
+        return self.overhead_sec, self.per_byte_sec
+
+    def bytes_per_record(self, record_length, channel_str, bytesPerSample = 2,
+                         preTriggerSamples = 0, sample_rate = None):
+        # same record length math as prepare_NPT
+        # sample_rate = float: in Hz after decimation, defaults to
+        #   samplesPerSec
+        if sample_rate is None:
+            sample_rate = samplesPerSec
+        samplesPerRecord = preTriggerSamples + \
+            record_samples(record_length, sample_rate)
+        return bytesPerSample * samplesPerRecord * channel_mask(channel_str)[1]
+
+    def plan(self, record_length, channel_str, records, trigger_rate,
+             bytesPerSample = 2, preTriggerSamples = 0, sample_rate = None):
+        # returns {'recordsPerBuffer', 'buffersPerAcquisition',
+        #   'buffer_count'} for at least the given number of records
+        # trigger_rate = float: expected records per second
+        key = (record_length, channel_str, records, trigger_rate,
+               bytesPerSample, preTriggerSamples, sample_rate)
+        self.last_key = key
+        if key in self.plans:
+            self.last_plan = self.plans[key]
+            return dict(self.last_plan)
+        bytesPerRecord = self.bytes_per_record(record_length, channel_str,
+                                               bytesPerSample,
+                                               preTriggerSamples, sample_rate)
+        
+        # processing a buffer has to fit in max_load of its period:
+        # overhead + per_byte * n * bytesPerRecord <= max_load * n / rate
+        per_record_sec = self.max_load / trigger_rate - \
+            self.per_byte_sec * bytesPerRecord
+        if per_record_sec <= 0:
+            print("Warning: processing can't keep up with %g records/sec" %
+                  trigger_rate)
+            min_records = math.inf
+        else:
+            min_records = math.ceil(self.overhead_sec / per_record_sec)
+        min_records = max(min_records,
+                          math.ceil(self.min_buffer_bytes / bytesPerRecord))
+        max_records = max(self.max_buffer_bytes // bytesPerRecord, 1)
+        # at least two buffers have to fit in the budget
+        max_records = max(min(max_records, self.memory_budget_bytes //
+                              (2 * bytesPerRecord)), 1)
+        recordsPerBuffer = max(min(min_records, max_records, records), 1)
+        
+        # spread the records evenly over the buffers, so the last buffer
+        # isn't mostly padding
+        buffersPerAcquisition = math.ceil(records / recordsPerBuffer)
+        recordsPerBuffer = math.ceil(records / buffersPerAcquisition)
+        bytesPerBuffer = recordsPerBuffer * bytesPerRecord
+        
+        # enough posted buffers to cover a stall, within the budget
+        period = recordsPerBuffer / trigger_rate
+        buffer_count = math.ceil(self.stall_sec / period) + 1
+        buffer_count = min(buffer_count,
+                           self.memory_budget_bytes // bytesPerBuffer,
+                           buffersPerAcquisition)
+        buffer_count = max(buffer_count, min(2, buffersPerAcquisition))
+        
+        self.last_plan = {'recordsPerBuffer': recordsPerBuffer,
+                          'buffersPerAcquisition': buffersPerAcquisition,
+                          'buffer_count': buffer_count}
+        self.plans[key] = self.last_plan
+        return dict(self.last_plan)
+
+    def report(self):
+        # prints the buffer size, period, expected load and memory of the
+        # last plan
+        plan = self.last_plan
+        (record_length, channel_str, records, trigger_rate, bytesPerSample,
+         preTriggerSamples, sample_rate) = self.last_key
+        bytesPerBuffer = plan['recordsPerBuffer'] * self.bytes_per_record(
+            record_length, channel_str, bytesPerSample, preTriggerSamples,
+            sample_rate)
+        period = plan['recordsPerBuffer'] / trigger_rate
+        load = (self.overhead_sec + self.per_byte_sec * bytesPerBuffer) / period
+        print("%d records/buffer (%.2f MB, %.3g ms), %d buffers, "
+              "%d buffers posted (%.1f MB), load %.0f%%" %
+              (plan['recordsPerBuffer'], bytesPerBuffer / 1e6, 1e3 * period,
+               plan['buffersPerAcquisition'], plan['buffer_count'],
+               plan['buffer_count'] * bytesPerBuffer / 1e6, 100 * load))
 
 class ats9462:
-    def __init__(self):
-        self.board = ats.Board(systemId = 1, boardId = 1)
+    def __init__(self, systemId = 1, boardId = 1):
+        # several boards are run together by ats_board_group
+        self.board = ats.Board(systemId = systemId, boardId = boardId)
+        # DMA buffers, channel info and the record size are kept between
+        # acquisitions, so a repeated acquisition with the same shape only
+        # costs beforeAsyncRead, post, start and wait
+        self.buffer_pool = dma_buffer_pool(self.board)
+        self.bitsPerSample = None
+        self.record_size = None
+        self.last_stats = None
+        self.converters = {}
+        # the last applied acquisition_config, also stored in capture file
+        # headers
+        self.params = None
         self.configure_default()
         
     def configure_default(self):
-        clock_params, \
-            channel_A_params, channel_A_bandwidth, \
-            channel_B_params, channel_B_bandwidth, \
-            trigger_params, external_trigger_params, \
-            trigger_delay, trigger_timeout, \
-            aux_io_params = get_default_params()
-
-        self.board.setCaptureClock(*clock_params)
-        self.board.inputControlEx(*channel_A_params)
-        self.board.setBWLimit(ats.CHANNEL_A, channel_A_bandwidth)
-        self.board.inputControlEx(*channel_B_params)
-        self.board.setBWLimit(ats.CHANNEL_B, channel_B_bandwidth)
-        self.board.setTriggerOperation(*trigger_params)
-        self.board.setExternalTrigger(*external_trigger_params)
-        self.board.setTriggerDelay(trigger_delay)
-        self.board.setTriggerTimeOut(trigger_timeout)
-        self.board.configureAuxIO(*aux_io_params)
+        # programs every setting from get_default_params
+        self.params = None
+        self.apply_config(get_default_params())
         
-    def acquire_NPT(self,
-                preTriggerSamples = 0, 
-                record_length = 10**-6, # in seconds
-                recordsPerBuffer = 1, 
-                buffersPerAcquisition = 1, 
-                buffer_count = 1, # number of buffers to allocate
-                channel_str = 'A', # 'A', 'B', or 'AB'
-                save_data = True, 
-                filename = None, 
-                return_data = False):
+    def apply_config(self, config):
+        # programs the board with an acquisition_config, sending only the
+        # settings that differ from the last applied config, so switching
+        # between measurement types in a sweep is cheap
+        # returns the names of the fields that were sent
+        changed = [name for name in acquisition_config._fields
+                   if self.params is None or
+                   getattr(config, name) != getattr(self.params, name)]
+        try:
+            for name in changed:
+                _config_calls[name](self.board, getattr(config, name))
+        except Exception:
+            # the board state is unknown, reprogram everything next time
+            self.params = None
+            raise
+        self.params = config
+        return changed
+
+    def samples_per_sec(self):
+        # sample rate of the acquired data in Hz, after decimation
+        return self.params.samplesPerSec
+
+    def set_sample_rate(self, sample_rate = None, decimation = None):
+        # reclocks the board, see acquisition_config.with_sample_rate. Only
+        # setCaptureClock (and setTriggerDelay) are sent, and nothing if the
+        # rate is already set. Capturing at a lower rate cuts DMA bandwidth,
+        # memory and disk for slow signals; record lengths stay in seconds
+        self.apply_config(self.params.with_sample_rate(sample_rate,
+                                                       decimation))
+        return self.samples_per_sec()
         
-        postTriggerSamples = math.ceil(record_length*samplesPerSec)
-                
-        # TODO: Select the active channels.
-        if channel_str == 'A':
-            channels = ats.CHANNEL_A
-        elif channel_str == 'B':
-            channels = ats.CHANNEL_B
-        elif channel_str == 'AB':
-            channels = ats.CHANNEL_A | ats.CHANNEL_B
+    def free_buffers(self):
+        # releases the page-locked DMA buffers kept between acquisitions
+        self.buffer_pool.clear()
+
+    def codes_to_volts(self, codes, channel = 'A', out = None,
+                       dtype = np.float32):
+        # converts sample codes from a buffer or capture to volts using the
+        # input range configured for channel
+        # codes = integer array, e.g. one view returned by split_channels
+        # channel = str: 'A' or 'B'
+        # out = array reused for the result, must have the same shape
+        # dtype = np.float32 or np.float64, ignored if out is given
+        if out is not None:
+            dtype = out.dtype
+        if channel == 'A':
+            input_range = self.params.channel_A_params[2]
         else:
-            sys.exit('ERROR: Invalid channel string')
+            input_range = self.params.channel_B_params[2]
+        bitsPerSample = 8 * codes.dtype.itemsize
+        key = (input_range, bitsPerSample, np.dtype(dtype))
+        if key not in self.converters:
+            self.converters[key] = code_converter(
+                input_range_volts[input_range], bitsPerSample, dtype)
+        return self.converters[key].convert(codes, out)
 
-        channelCount = 0
-        for c in ats.channels:
-            channelCount += (c & channels == c)
+    def bytes_per_sample(self):
+        # queried from the board once
+        if self.bitsPerSample is None:
+            memorySize_samples, bitsPerSample = self.board.getChannelInfo()
+            self.bitsPerSample = bitsPerSample.value
+        return (self.bitsPerSample + 7) // 8
 
-        # TODO: Should data be saved to file? YES
-        if save_data:
-            dataFile = open(os.path.join(os.getcwd(),
-                                         filename), 'wb')
-            #print('SAVING DATA')
-            #print(dataFile)
-            #print(filename)
+    def capture_metadata(self, info, mode = 'NPT'):
+        # returns the header of a capture file, see CAPTURE FILES
+        # info = acquisition_info
+        return {'params': params_to_dict(self.params),
+                'mode': mode,
+                'samplesPerSec': info.samplesPerSec,
+                'channel_str': info.channel_str,
+                'channelCount': info.channelCount,
+                'preTriggerSamples': info.preTriggerSamples,
+                'samplesPerRecord': info.samplesPerRecord,
+                'recordsPerBuffer': info.recordsPerBuffer,
+                'buffersPerAcquisition': info.buffersPerAcquisition,
+                'bytesPerSample': info.bytesPerSample,
+                'dtype': np.dtype(info.sample_dtype).newbyteorder('<').str,
+                'layout': ['buffer', 'record', 'sample', 'channel'],
+                'simulated': simulated,
+                'buffers_saved': 0,
+                'start_time': time.time(),
+                'stop_time': None}
+
+    def prepare_NPT(self, preTriggerSamples, record_length, recordsPerBuffer,
+                    buffersPerAcquisition, buffer_count, channel_str,
+                    sample_rate = None, decimation = None):
+        # configures the board for an NPT AutoDMA acquisition and returns
+        # (acquisition_info, list of DMA buffers). The buffers are not posted
+        # sample_rate, decimation = see set_sample_rate, None keeps the
+        #   current clock
         
-        if return_data:
-            data_list = []
+        if sample_rate is not None or decimation is not None:
+            self.set_sample_rate(sample_rate, decimation)
+        samplesPerSec = self.samples_per_sec()
+        postTriggerSamples = record_samples(record_length, samplesPerSec)
+                
+        channels, channelCount = channel_mask(channel_str)
         
         # Compute the number of bytes per record and per buffer
-        memorySize_samples, bitsPerSample = self.board.getChannelInfo()
-        bytesPerSample = (bitsPerSample.value + 7) // 8
+        bytesPerSample = self.bytes_per_sample()
         samplesPerRecord = preTriggerSamples + postTriggerSamples
         bytesPerRecord = bytesPerSample * samplesPerRecord
         bytesPerBuffer = bytesPerRecord * recordsPerBuffer * channelCount
@@ -154,13 +1853,13 @@ class ats9462:
         if bytesPerSample > 1:
             sample_type = ctypes.c_uint16
             
-        buffers = []
-        for i in range(buffer_count):
-            buffers.append(ats.DMABuffer(self.board.handle, sample_type, \
-                                         bytesPerBuffer))
+        buffers = self.buffer_pool.get(sample_type, bytesPerBuffer,
+                                       buffer_count)
         
-        # Set the record size
-        self.board.setRecordSize(preTriggerSamples, postTriggerSamples)
+        # Set the record size, unless the board already has it
+        if self.record_size != (preTriggerSamples, postTriggerSamples):
+            self.board.setRecordSize(preTriggerSamples, postTriggerSamples)
+            self.record_size = (preTriggerSamples, postTriggerSamples)
     
         recordsPerAcquisition = recordsPerBuffer * buffersPerAcquisition
         
@@ -172,26 +1871,156 @@ class ats9462:
                               recordsPerAcquisition,
                               ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_NPT)
         
-        # Post DMA buffers to board
-        for buffer in buffers:
-            self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+        info = acquisition_info(channel_str, channelCount, samplesPerSec,
+                                preTriggerSamples, samplesPerRecord,
+                                recordsPerBuffer, buffersPerAcquisition,
+                                bytesPerSample)
+        return info, buffers
+
+    def acquire_NPT(self,
+                preTriggerSamples = 0, 
+                record_length = 10**-6, # in seconds
+                recordsPerBuffer = 1, 
+                buffersPerAcquisition = 1, 
+                buffer_count = 1, # number of buffers to allocate
+                channel_str = 'A', # 'A', 'B', or 'AB'
+                save_data = True, 
+                filename = None, 
+                file_header = True, # False writes a headerless raw file
+                return_data = False, # True: list of buffers, 'array': ndarray
+                out = None, # preallocated (buffers, records, samples, channels)
+                max_memory_bytes = None, # spill 'array' data to disk above this
+                spill_filename = None,
+                use_writer_thread = False, # write to disk from a separate thread
+                writer_queue_size = None, # defaults to buffer_count - 1
+                drop_when_full = False, # drop buffers if the writer falls behind
+                processor = None, # e.g. record_averager, see BUFFER PROCESSORS
+                stats_filename = None, # JSON sidecar for acquisition_stats
+                select = None, # keep only some records, see record_selector
+                sample_rate = None, # in Hz, None keeps the current clock
+                decimation = None, # see set_sample_rate
+                start_barrier = None, # threading.Barrier, see ats_board_group
+                start_capture = True, # False for a slave board, see ats_board_group
+                stop_event = None): # threading.Event to stop from outside
+        # timing of every buffer is kept in self.last_stats, see
+        # acquisition_stats
+        # with select, only the records that pass are written to file (as
+        #   buffers of one record) and returned in the list; processors still
+        #   see every record. Counts are kept in self.last_selection
         
-        start = time.clock() # Keep track of when acquisition starteda
+        info, buffers = self.prepare_NPT(preTriggerSamples, record_length,
+                                         recordsPerBuffer,
+                                         buffersPerAcquisition, buffer_count,
+                                         channel_str, sample_rate, decimation)
+        channelCount = info.channelCount
+        samplesPerRecord = info.samplesPerRecord
+        bytesPerBuffer = buffers[0].size_bytes
+
+        # Everything after prepare_NPT armed the board runs inside the try,
+        # so a failing setup step still aborts the board and releases the
+        # file, writer and processor
+        dataFile = None
+        writer = None
+        header = None
+        recordsAccepted = 0
+        recordsRejected = 0
+        clock = time.perf_counter
+        timings = np.zeros((buffersPerAcquisition, 4))
+        completed = np.zeros(buffersPerAcquisition)
+        start = clock()
+        buffersCompleted = 0
+        bytesTransferred = 0
         try:
-            self.board.startCapture() # Start the acquisition
-            t0 = time.time()
+            # processors check their settings against the geometry here,
+            # before any file is created
+            if processor:
+                processor.start(info)
+            if hasattr(select, 'start'):
+                select.start(info)
+            
+            # TODO: Should data be saved to file? YES
+            if save_data:
+                dataFile = open(os.path.join(os.getcwd(),
+                                             filename), 'wb')
+                #print('SAVING DATA')
+                #print(dataFile)
+                #print(filename)
+            
+            # Returned data either goes into one preallocated array that
+            # every buffer is copied into in place, or into a list of buffer
+            # copies
+            if out is not None or return_data == 'array':
+                if select is not None:
+                    raise ValueError('select does not work with a '
+                                     'preallocated array, use return_data '
+                                     '= True')
+                if out is None:
+                    out = allocate_data_array(buffersPerAcquisition,
+                                              recordsPerBuffer,
+                                              samplesPerRecord, channelCount,
+                                              info.sample_dtype,
+                                              max_memory_bytes,
+                                              spill_filename)
+                elif out.shape != (buffersPerAcquisition, recordsPerBuffer,
+                                   samplesPerRecord, channelCount):
+                    raise ValueError('out has shape %s, expected %s' %
+                                     (out.shape, (buffersPerAcquisition,
+                                      recordsPerBuffer, samplesPerRecord,
+                                      channelCount)))
+                return_data = 'array'
+            elif return_data:
+                data_list = []
+            
+            # Optionally hand disk writes off to a background thread. The
+            # writer needs at least one buffer that is not queued so the
+            # board always has somewhere to put data
+            if use_writer_thread and dataFile:
+                if writer_queue_size is None:
+                    writer_queue_size = max(buffer_count - 1, 1)
+                writer = ats_buffer_writer(self.board, dataFile,
+                                           writer_queue_size, drop_when_full)
+            
+            # Self-describing capture file, see CAPTURE FILES. The header is
+            # rewritten with the number of saved buffers once the capture is
+            # done
+            if dataFile and file_header:
+                header = self.capture_metadata(info)
+                if select is not None:
+                    # selected records are saved one per buffer
+                    header['recordsPerBuffer'] = 1
+                    header['selected'] = True
+                data_offset = write_capture_header(dataFile, header)
+            
+            # Post DMA buffers to board
+            start = clock() # Keep track of when acquisition started
+            for buffer in buffers:
+                if writer:
+                    writer.post(buffer)
+                else:
+                    self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            
+            if start_barrier is not None:
+                # every board of a group is armed before any starts
+                start_barrier.wait()
+            if start_capture:
+                self.board.startCapture() # Start the acquisition
             print("Capturing %d buffers. Press <enter> to abort" %
                   buffersPerAcquisition)
-            buffersCompleted = 0
-            bytesTransferred = 0
             while (buffersCompleted < buffersPerAcquisition and not
-                   ats.enter_pressed()):
+                   ats.enter_pressed() and not processor_done(processor) and
+                   not (stop_event and stop_event.is_set())):
                 # Wait for the buffer at the head of the list of available
                 # buffers to be filled by the board.
-                buffer = buffers[buffersCompleted % len(buffers)]
-                t1 = time.time()
+                if writer:
+                    buffer = writer.next_buffer()
+                else:
+                    buffer = buffers[buffersCompleted % len(buffers)]
+                t1 = clock()
                 self.board.waitAsyncBufferComplete(buffer.addr, timeout_ms=5000)
-                t2 = time.time()
+                t2 = clock()
+                timing = timings[buffersCompleted]
+                timing[0] = t2 - t1
+                completed[buffersCompleted] = t2 - start
                 buffersCompleted += 1
                 bytesTransferred += buffer.size_bytes
     
@@ -220,21 +2049,88 @@ class ats9462:
                 
                 #print(buffer.buffer)
                 
-                if dataFile:
-                    buffer.buffer.tofile(dataFile)
-                    if return_data:
+                if processor:
+                    processor.process(records_view(buffer.buffer,
+                        recordsPerBuffer, samplesPerRecord, channelCount))
+                
+                if select is not None:
+                    # compact the passing records into one copy, the DMA
+                    # buffer can then go straight back to the board
+                    records = records_view(buffer.buffer, recordsPerBuffer,
+                                           samplesPerRecord, channelCount)
+                    selected = records[select(records)]
+                    recordsAccepted += selected.shape[0]
+                    recordsRejected += recordsPerBuffer - selected.shape[0]
+                
+                if return_data == 'array':
+                    out[buffersCompleted - 1] = records_view(buffer.buffer,
+                        recordsPerBuffer, samplesPerRecord, channelCount)
+                elif return_data:
+                    if select is not None:
+                        data_list.append(selected)
+                    else:
                         data_list.append(buffer.buffer.copy())
-                        #print('Data list: \n')
-                        #print(data_list)
+                    #print('Data list: \n')
+                    #print(data_list)
+                t3 = clock()
+                timing[1] = t3 - t2
+                
+                if dataFile:
+                    if select is not None:
+                        if writer:
+                            writer.submit(None, selected,
+                                          buffersCompleted - 1)
+                        else:
+                            selected.tofile(dataFile)
+                    elif writer:
+                        # the writer posts the buffer back once it's written
+                        writer.submit(buffer, None, buffersCompleted - 1)
+                        timing[2] = clock() - t3
+                        continue
+                    else:
+                        buffer.buffer.tofile(dataFile)
+                t4 = clock()
+                timing[2] = t4 - t3
     
                 # Add the buffer to the end of the list of available buffers.
-                self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+                if writer:
+                    writer.post(buffer)
+                else:
+                    self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+                timing[3] = clock() - t4
         finally:
-            t3 = time.time()
-            self.board.abortAsyncRead()
-            t4 = time.time()
+            try:
+                if writer:
+                    writer.close()
+            finally:
+                self.board.abortAsyncRead()
+                processor_close(processor)
+                if dataFile:
+                    try:
+                        if header is not None:
+                            # whatever made it to disk, dropped buffers and
+                            # rejected records included
+                            savedBytes = dataFile.tell() - data_offset
+                            header['buffers_saved'] = savedBytes // \
+                                (header['recordsPerBuffer'] *
+                                 samplesPerRecord * channelCount *
+                                 info.bytesPerSample)
+                            if select is not None:
+                                header['records_accepted'] = recordsAccepted
+                                header['records_rejected'] = recordsRejected
+                            if writer:
+                                # buffers missing from the file, as
+                                # [first, count] runs in acquisition order
+                                header['dropped_buffers'] = index_ranges(
+                                    writer.dropped_buffers)
+                            header['stop_time'] = time.time()
+                            finish_capture_header(dataFile, header,
+                                                  data_offset,
+                                                  ['dropped_buffers'])
+                    finally:
+                        dataFile.close()
         # Compute the total transfer time, and display performance information.
-        transferTime_sec = time.clock() - start
+        transferTime_sec = clock() - start
         print("Capture completed in %f sec" % transferTime_sec)
         buffersPerSec = 0
         bytesPerSec = 0
@@ -249,16 +2145,549 @@ class ats9462:
               (recordsPerBuffer * buffersCompleted, recordsPerSec))
         print("Transferred %d bytes (%f bytes per sec)" %
               (bytesTransferred, bytesPerSec))
-    
-        print('Start to Wait: '+str(t1-t0))
-        print('Wait time: '+str(t2-t1))
-        print('Finish of wait to the end: '+str(t3-t2))
-        print('Final step time: '+str(t4-t3))
+        if writer:
+            writer.report()
+        if select is not None:
+            self.last_selection = {'accepted': recordsAccepted,
+                                   'rejected': recordsRejected}
+            print("Selected %d of %d records" %
+                  (recordsAccepted, recordsAccepted + recordsRejected))
         
-        print('Transfer time - the rest = '+str(transferTime_sec-t4+t0))
+        self.last_stats = acquisition_stats(timings[:buffersCompleted],
+                                            completed[:buffersCompleted],
+                                            bytesPerBuffer)
+        self.last_stats.report()
+        if stats_filename:
+            self.last_stats.save(stats_filename)
         
+        if processor:
+            return processor.result()
+        if return_data == 'array':
+            if isinstance(out, np.memmap):
+                out.flush()
+            # only the buffers that were filled if the capture was aborted
+            return out[:buffersCompleted]
         if return_data:
             return data_list
+
+    def iter_buffers(self,
+                     preTriggerSamples = 0,
+                     record_length = 10**-6, # in seconds
+                     recordsPerBuffer = 1,
+                     buffersPerAcquisition = 1,
+                     buffer_count = 2, # number of buffers to allocate
+                     channel_str = 'A', # 'A', 'B', or 'AB'
+                     volts = False,
+                     dtype = np.float32, # for volts
+                     sample_rate = None, # in Hz, see set_sample_rate
+                     decimation = None):
+        # streams an NPT acquisition, yielding every filled buffer as a
+        # (records, samples, channels) array
+        # volts = False: the array is a read-only view of the DMA buffer
+        # volts = True: the array holds the buffer converted to volts, the
+        #   same output array is reused for every buffer
+        # Either way the array is only valid until the next buffer is asked
+        # for: the DMA buffer is posted back to the board when the consumer
+        # advances. Leaving the loop early aborts the acquisition cleanly
+        # usage:
+        #   for records in digitizer.iter_buffers(recordsPerBuffer = 100,
+        #                                         buffersPerAcquisition = 10**4):
+        #       ...
+        #       if converged:
+        #           break
+        info, buffers = self.prepare_NPT(preTriggerSamples, record_length,
+                                         recordsPerBuffer,
+                                         buffersPerAcquisition, buffer_count,
+                                         channel_str, sample_rate, decimation)
+        try:
+            if volts:
+                converted = np.empty((recordsPerBuffer, info.samplesPerRecord,
+                                      info.channelCount), dtype = dtype)
+            for buffer in buffers:
+                self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self.board.startCapture()
+            buffersCompleted = 0
+            while buffersCompleted < buffersPerAcquisition:
+                buffer = buffers[buffersCompleted % len(buffers)]
+                self.board.waitAsyncBufferComplete(buffer.addr, timeout_ms=5000)
+                buffersCompleted += 1
+                records = records_view(buffer.buffer, recordsPerBuffer,
+                                       info.samplesPerRecord,
+                                       info.channelCount)
+                if volts:
+                    for c, channel in enumerate(channel_str):
+                        self.codes_to_volts(records[..., c], channel,
+                                            converted[..., c])
+                    yield converted
+                else:
+                    view = records.view()
+                    view.flags.writeable = False
+                    yield view
+                self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+        finally:
+            self.board.abortAsyncRead()
+
+    def acquire_continuous(self,
+                           samplesPerBuffer = 2**20, # per channel
+                           buffer_count = 16, # number of buffers to allocate
+                           channel_str = 'A', # 'A', 'B', or 'AB'
+                           triggered = False, # TS instead of CS mode
+                           duration = None, # in seconds, None runs until stopped
+                           max_buffers = None,
+                           stop_event = None, # threading.Event to stop from outside
+                           save_data = True,
+                           filename = 'stream', # files are filename_0000.bin, ...
+                           rotate_bytes = 2**30, # start a new file above this size
+                           rotate_sec = None, # or after this many seconds
+                           restart_on_overflow = True,
+                           processor = None,
+                           sample_rate = None, # in Hz, see set_sample_rate
+                           decimation = None):
+        # gapless continuous streaming (CS) or triggered streaming (TS)
+        # AutoDMA acquisition. Runs until duration, max_buffers, stop_event
+        # or <enter>, whichever comes first
+        # Every buffer is one record of samplesPerBuffer interleaved samples,
+        # and each output file is a capture file (see CAPTURE FILES) that
+        # ats_capture can open. The loop itself allocates nothing: buffers
+        # come from the pool and go straight to disk or the processor
+        # A buffer overflow stops the board; with restart_on_overflow the
+        # stream is restarted and the gap is recorded
+        # processor = see BUFFER PROCESSORS; processors that keep one result
+        #   per record need max_buffers
+        # returns the processor result if given, otherwise a summary dict
+        #   that is also kept in self.last_stream
+        if sample_rate is not None or decimation is not None:
+            self.set_sample_rate(sample_rate, decimation)
+        samplesPerSec = self.samples_per_sec()
+        channels, channelCount = channel_mask(channel_str)
+        bytesPerSample = self.bytes_per_sample()
+        sample_type = ctypes.c_uint8
+        if bytesPerSample > 1:
+            sample_type = ctypes.c_uint16
+        bytesPerBuffer = bytesPerSample * samplesPerBuffer * channelCount
+        buffers = self.buffer_pool.get(sample_type, bytesPerBuffer,
+                                       buffer_count)
+        info = acquisition_info(channel_str, channelCount, samplesPerSec, 0,
+                                samplesPerBuffer, 1, max_buffers,
+                                bytesPerSample)
+        if triggered:
+            mode = 'TS'
+            flags = ats.ADMA_EXTERNAL_STARTCAPTURE | \
+                ats.ADMA_TRIGGERED_STREAMING
+        else:
+            mode = 'CS'
+            flags = ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_CONTINUOUS_MODE
+        
+        # timing of the most recent buffers, kept in a fixed ring so long
+        # runs don't grow memory
+        clock = time.perf_counter
+        ring = 4096
+        timings = np.zeros((ring, 4))
+        completed = np.zeros(ring)
+        
+        files = []
+        gaps = []
+        dataFile = None
+        # an overflow while no file is open is a gap at the start of the next
+        gap_before_file = False
+        buffersCompleted = 0
+        
+        def open_file():
+            # starts the next output file, with the buffer about to be
+            # written as its first
+            name = os.path.join(os.getcwd(),
+                                '%s_%04d.bin' % (filename, len(files)))
+            f = open(name, 'wb')
+            header = self.capture_metadata(info, mode)
+            header['first_buffer'] = buffersCompleted - 1
+            header['gaps'] = [0] if gap_before_file else []
+            files.append(name)
+            return f, header, write_capture_header(f, header), clock()
+        
+        def close_file(f, header, data_offset):
+            try:
+                header['stop_time'] = time.time()
+                finish_capture_header(f, header, data_offset, ['gaps'])
+            finally:
+                f.close()
+        
+        def arm():
+            self.board.beforeAsyncRead(channels, 0, samplesPerBuffer, 1,
+                                       0x7FFFFFFF, flags)
+            for buffer in buffers:
+                self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self.board.startCapture()
         
+        start = clock()
+        try:
+            # inside the try, so a failing start still closes the processor
+            if processor:
+                processor.start(info)
+            print("Streaming %s mode. Press <enter> to stop" % mode)
+            arm()
+            bufferIndex = 0
+            while not ats.enter_pressed():
+                if max_buffers is not None and buffersCompleted >= max_buffers:
+                    break
+                if duration is not None and clock() - start >= duration:
+                    break
+                if stop_event is not None and stop_event.is_set():
+                    break
+                if processor_done(processor):
+                    break
+                buffer = buffers[bufferIndex % len(buffers)]
+                t1 = clock()
+                try:
+                    self.board.waitAsyncBufferComplete(buffer.addr,
+                                                       timeout_ms=5000)
+                except Exception as e:
+                    if not (restart_on_overflow and 'Overflow' in str(e)):
+                        raise
+                    # data between the last good buffer and the restart is lost
+                    gaps.append((buffersCompleted, clock() - start))
+                    print('Buffer overflow after %d buffers, restarting' %
+                          buffersCompleted)
+                    if dataFile:
+                        header['gaps'].append(buffersCompleted -
+                                              header['first_buffer'])
+                    elif save_data:
+                        gap_before_file = True
+                    self.board.abortAsyncRead()
+                    arm()
+                    bufferIndex = 0
+                    continue
+                t2 = clock()
+                timing = timings[buffersCompleted % ring]
+                timing[0] = t2 - t1
+                completed[buffersCompleted % ring] = t2 - start
+                buffersCompleted += 1
+                bufferIndex += 1
+                
+                if processor:
+                    processor.process(records_view(buffer.buffer, 1,
+                        samplesPerBuffer, channelCount))
+                t3 = clock()
+                timing[1] = t3 - t2
+                
+                if save_data:
+                    # files are opened when there is data for them, so a run
+                    # that ends right after a rotation leaves no empty file
+                    if dataFile is None:
+                        dataFile, header, data_offset, opened = open_file()
+                        gap_before_file = False
+                    buffer.buffer.tofile(dataFile)
+                    header['buffers_saved'] += 1
+                    if ((rotate_bytes and
+                         header['buffers_saved'] * bytesPerBuffer >= rotate_bytes)
+                            or (rotate_sec and clock() - opened >= rotate_sec)):
+                        close_file(dataFile, header, data_offset)
+                        dataFile = None
+                t4 = clock()
+                timing[2] = t4 - t3
+                
+                self.board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+                timing[3] = clock() - t4
+        finally:
+            self.board.abortAsyncRead()
+            processor_close(processor)
+            if dataFile:
+                close_file(dataFile, header, data_offset)
+        elapsed = clock() - start
         
-        
\ No newline at end of file
+        n = min(buffersCompleted, ring)
+        order = np.arange(buffersCompleted - n, buffersCompleted) % ring
+        self.last_stats = acquisition_stats(timings[order], completed[order],
+                                            bytesPerBuffer)
+        bytesTransferred = buffersCompleted * bytesPerBuffer
+        self.last_stream = {'mode': mode,
+                            'buffers': buffersCompleted,
+                            'bytes': bytesTransferred,
+                            'elapsed_sec': elapsed,
+                            'bytes_per_sec': bytesTransferred / elapsed
+                                             if elapsed > 0 else 0.0,
+                            'files': files,
+                            'gaps': gaps}
+        print("Streamed %d buffers in %f sec (%f bytes per sec)" %
+              (buffersCompleted, elapsed, self.last_stream['bytes_per_sec']))
+        print("Gaps: %d, files written: %d" % (len(gaps), len(files)))
+        self.last_stats.report()
+        
+        if processor:
+            return processor.result()
+        return self.last_stream
+
+    def acquire_average(self, return_variance = False, **kwargs):
+        # averages all records of an NPT acquisition on the fly, no raw data
+        # is written or kept
+        # return_variance = bool
+        # kwargs are passed to acquire_NPT (record_length, recordsPerBuffer,
+        #   buffersPerAcquisition, buffer_count, channel_str, ...)
+        # returns the mean record in sample codes, shape (samples, channels),
+        #   and the variance if return_variance
+        return self.acquire_NPT(save_data = False,
+                                processor = record_averager(return_variance),
+                                **kwargs)
+
+    def acquire_iq(self, if_freq, window_start = 0, window_length = None,
+                   channel = 'A', **kwargs):
+        # demodulates every record of an NPT acquisition on the fly, see
+        # iq_demodulator. No raw data is written or kept
+        # kwargs are passed to acquire_NPT
+        # returns a (records,) complex array
+        demodulator = iq_demodulator(if_freq, window_start, window_length,
+                                     channel)
+        return self.acquire_NPT(save_data = False, processor = demodulator,
+                                **kwargs)
+
+    def acquire_multitone(self, if_freqs, window_start = 0,
+                          window_length = None, channel = 'A', **kwargs):
+        # demodulates every record against several IF frequencies on the fly,
+        # see multitone_demodulator. No raw data is written or kept
+        # kwargs are passed to acquire_NPT
+        # returns a (records, N) complex array
+        demodulator = multitone_demodulator(if_freqs, window_start,
+                                            window_length, channel)
+        return self.acquire_NPT(save_data = False, processor = demodulator,
+                                **kwargs)
+
+    def acquire_psd(self, segment_length, overlap = 0.5, volts = True,
+                    **kwargs):
+        # noise spectrum of an NPT acquisition, see psd_accumulator. No raw
+        # data is written or kept
+        # volts = bool: PSD in V^2/Hz using the range of each acquired
+        #   channel, otherwise in codes^2/Hz
+        # kwargs are passed to acquire_NPT
+        # returns (freqs, psd) and the A.B* cross spectrum for 'AB'
+        full_scale = None
+        if volts:
+            ranges = {'A': self.params.channel_A_params[2],
+                      'B': self.params.channel_B_params[2]}
+            full_scale = [input_range_volts[ranges[channel]]
+                          for channel in kwargs.get('channel_str', 'A')]
+        accumulator = psd_accumulator(segment_length, overlap,
+                                      full_scale = full_scale)
+        return self.acquire_NPT(save_data = False, processor = accumulator,
+                                **kwargs)
+
+    def acquire_correlation(self, max_lag, normalize = False, **kwargs):
+        # averaged A/B cross-correlation of an NPT acquisition, see
+        # cross_correlator. No raw data is written or kept
+        # kwargs are passed to acquire_NPT, channel_str is always 'AB'
+        # returns (lags in seconds, correlation)
+        correlator = cross_correlator(max_lag, normalize = normalize)
+        return self.acquire_NPT(save_data = False, processor = correlator,
+                                channel_str = 'AB', **kwargs)
+
+    def acquire_iq_histogram(self, if_freq, i_range, q_range, bins = 100,
+                             window_start = 0, window_length = None,
+                             channel = 'A', histogram = None, **kwargs):
+        # single-shot IQ histogram of an NPT acquisition, see iq_histogram.
+        # No raw data or individual shots are kept
+        # histogram = iq_histogram: pass the result of an earlier call's
+        #   histogram to keep accumulating into it; the other arguments
+        #   except kwargs are ignored then
+        # kwargs are passed to acquire_NPT
+        # returns the iq_histogram, see iq_histogram.result()
+        if histogram is None:
+            demodulator = iq_demodulator(if_freq, window_start,
+                                         window_length, channel)
+            histogram = iq_histogram(demodulator, i_range, q_range, bins)
+        self.acquire_NPT(save_data = False, processor = histogram, **kwargs)
+        return histogram
+
+    def acquire_until_converged(self, if_freq, target_error, quantity = 'I',
+                                threshold = None, min_records = 100,
+                                window_start = 0, window_length = None,
+                                channel = 'A', **kwargs):
+        # demodulated NPT acquisition that stops as soon as the standard
+        # error of quantity reaches target_error, see convergence_monitor.
+        # buffersPerAcquisition (in kwargs) is the upper limit
+        # kwargs are passed to acquire_NPT
+        # returns (mean, standard error, number of records used)
+        demodulator = iq_demodulator(if_freq, window_start, window_length,
+                                     channel)
+        monitor = convergence_monitor(demodulator, target_error, quantity,
+                                      threshold, min_records)
+        mean, error, records = self.acquire_NPT(save_data = False,
+                                                processor = monitor,
+                                                **kwargs)
+        if monitor.done:
+            print('Target error reached after %d records' % records)
+        else:
+            print('Target error not reached, error %g after %d records' %
+                  (error, records))
+        return mean, error, records
+
+    def acquire_decimated(self, decimation, lo_freq = None, cutoff = None,
+                          **kwargs):
+        # NPT acquisition filtered and decimated record by record, see
+        # decimating_filter. No raw data is written or kept
+        # kwargs are passed to acquire_NPT
+        # returns (records, samples, channels) at samplesPerSec / decimation,
+        #   complex baseband if lo_freq is given
+        fir = decimating_filter(decimation, cutoff = cutoff,
+                                lo_freq = lo_freq)
+        return self.acquire_NPT(save_data = False, processor = fir,
+                                **kwargs)
+
+class ats_board_group:
+    # runs NPT acquisitions on several boards at the same time, e.g. to get
+    # more readout channels from a second digitizer. Each board gets its own
+    # thread: every board is configured and has its DMA buffers posted before
+    # any capture starts, and the waits then run concurrently since the
+    # driver releases the GIL
+    # Boards with the same systemId are a master/slave (SyncBoard) system:
+    # only the master, the lowest boardId, calls startCapture, which starts
+    # the slaves with it. Boards in different systems are independent and
+    # each starts itself; they have to share the external trigger, and the
+    # trigger source should start after the boards are armed, otherwise the
+    # boards don't see the same first record
+    # board_ids = list of (systemId, boardId)
+
+    def __init__(self, board_ids = ((1, 1), (1, 2))):
+        self.board_ids = [tuple(ids) for ids in board_ids]
+        self.digitizers = [ats9462(systemId, boardId)
+                           for systemId, boardId in self.board_ids]
+        # whether each board starts its own capture, i.e. is not a slave
+        self.starts_capture = [
+            boardId == min(b for s, b in self.board_ids if s == systemId)
+            for systemId, boardId in self.board_ids]
+        self.last_stats = None
+
+    def apply_config(self, config):
+        # config = acquisition_config for every board, or a list with one
+        #   per board. Only the changed settings are sent, see
+        #   ats9462.apply_config
+        if isinstance(config, acquisition_config):
+            config = [config] * len(self.digitizers)
+        return [digitizer.apply_config(c)
+                for digitizer, c in zip(self.digitizers, config)]
+
+    def set_sample_rate(self, sample_rate = None, decimation = None):
+        # same clock on every board, see ats9462.set_sample_rate
+        return [digitizer.set_sample_rate(sample_rate, decimation)
+                for digitizer in self.digitizers][0]
+
+    def acquire_NPT(self, channel_str = 'A', processor = None,
+                    filename = None, save_data = True, **kwargs):
+        # runs acquire_NPT on every board and merges the results record by
+        # record; if a board stops early the others are stopped and the
+        # results are cut to the records every board has
+        # channel_str = str for every board, or a list with one per board
+        # processor = function returning a new processor for each board,
+        #   e.g. lambda: iq_demodulator(10e6). Results are stacked with the
+        #   board as the last axis
+        # filename = each board saves to filename with _board<n> added
+        # kwargs are passed to acquire_NPT. With return_data = 'array' the
+        #   channels of all boards are concatenated in board order
+        # returns the merged result, the result of every board is kept in
+        #   self.last_results and its acquisition_stats in self.last_stats
+        if kwargs.get('select') is not None:
+            raise ValueError('select keeps different records on each board, '
+                             'so the results can\'t be aligned')
+        if kwargs.get('out') is not None:
+            raise ValueError('out is not supported, use return_data = '
+                             '\'array\'')
+        count = len(self.digitizers)
+        if isinstance(channel_str, str):
+            channel_str = [channel_str] * count
+        if save_data:
+            if filename is None:
+                raise ValueError('save_data needs a filename')
+            root, ext = os.path.splitext(filename)
+            filenames = ['%s_board%d%s' % (root, n, ext) for n in range(count)]
+        else:
+            filenames = [None] * count
+        processors = [processor() if processor else None for n in range(count)]
+        barrier = threading.Barrier(count)
+        stop_event = threading.Event()
+        results = [None] * count
+        errors = [None] * count
+        
+        def run(n):
+            digitizer = self.digitizers[n]
+            try:
+                results[n] = digitizer.acquire_NPT(
+                    channel_str = channel_str[n], processor = processors[n],
+                    save_data = save_data, filename = filenames[n],
+                    start_barrier = barrier,
+                    start_capture = self.starts_capture[n],
+                    stop_event = stop_event, **kwargs)
+            except threading.BrokenBarrierError as e:
+                errors[n] = e
+            except BaseException as e:
+                errors[n] = e
+                # release the boards still waiting to start, and stop the
+                # ones already running
+                barrier.abort()
+                stop_event.set()
+            else:
+                # stopped early, e.g. <enter> on this board
+                if len(digitizer.last_stats.busy()) < \
+                        kwargs.get('buffersPerAcquisition', 1):
+                    stop_event.set()
+        
+        threads = [threading.Thread(target = run, args = (n,), daemon = True)
+                   for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # raise the error that caused the others
+        for e in errors:
+            if e is not None and not isinstance(e,
+                                                threading.BrokenBarrierError):
+                raise e
+        for e in errors:
+            if e is not None:
+                raise e
+        
+        self.last_results = results
+        self.last_stats = [digitizer.last_stats
+                           for digitizer in self.digitizers]
+        if processor:
+            return self.merge_processed(results)
+        return self.merge_records(results, channel_str,
+                                  kwargs.get('recordsPerBuffer', 1),
+                                  kwargs.get('return_data', False))
+
+    def merge_processed(self, results):
+        # stacks processor results with the board as the last axis, cut to
+        # the records every board has. Results that can't be stacked, e.g.
+        # tuples or different shapes, are returned as a list
+        arrays = [np.asarray(r) for r in results]
+        if any(a.ndim == 0 or a.dtype == object or
+               a.shape[1:] != arrays[0].shape[1:] for a in arrays):
+            return results
+        records = min(len(a) for a in arrays)
+        return np.stack([a[:records] for a in arrays], axis = -1)
+
+    def merge_records(self, results, channel_str, recordsPerBuffer,
+                      return_data):
+        # concatenates the channels of every board, in board order, cut to
+        # the buffers every board has
+        if not return_data:
+            return None
+        buffers = min(len(r) for r in results)
+        if return_data == 'array':
+            return np.concatenate([r[:buffers] for r in results], axis = -1)
+        # lists of flat buffers
+        return [np.concatenate([records_view(r[b], recordsPerBuffer, -1,
+                                             len(channels))
+                                for r, channels in zip(results, channel_str)],
+                               axis = -1)
+                for b in range(buffers)]
+
+    def acquire_iq(self, if_freq, window_start = 0, window_length = None,
+                   channel = 'A', **kwargs):
+        # demodulates every record of every board, see ats9462.acquire_iq
+        # returns a (records, boards) complex array
+        return self.acquire_NPT(save_data = False,
+                                processor = lambda: iq_demodulator(
+                                    if_freq, window_start, window_length,
+                                    channel),
+                                **kwargs)
+
+    def free_buffers(self):
+        for digitizer in self.digitizers:
+            digitizer.free_buffers()
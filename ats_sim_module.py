@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated stand-in for atsapi, for running and benchmarking ats_module away
+from the lab PC. Only the parts of atsapi used by ats_module are provided.
+
+The simulated board fills posted DMA buffers with a synthetic signal at a
+fixed trigger rate. If the host doesn't post buffers back in time, records
+pile up in the on-board memory, and once that is full the next wait raises
+an ApiBufferOverflow error like the real board.
+
+Use it by setting the ATS_SIMULATE environment variable before importing
+ats_module, and tune it with set_simulation(). Capture files written from a
+simulated board have 'simulated': true in their header.
+"""
+import ctypes
+import collections
+import math
+import time
+import numpy as np
+
+#########################
+# atsapi constants used #
+#########################
+
+INTERNAL_CLOCK = 0x1
+EXTERNAL_CLOCK_10MHz_REF = 0x7
+CLOCK_EDGE_RISING = 0
+
+SAMPLE_RATE_1KSPS = 0x1
+SAMPLE_RATE_2KSPS = 0x2
+SAMPLE_RATE_5KSPS = 0x4
+SAMPLE_RATE_10KSPS = 0x8
+SAMPLE_RATE_20KSPS = 0xA
+SAMPLE_RATE_50KSPS = 0xC
+SAMPLE_RATE_100KSPS = 0xE
+SAMPLE_RATE_200KSPS = 0x10
+SAMPLE_RATE_500KSPS = 0x12
+SAMPLE_RATE_1MSPS = 0x14
+SAMPLE_RATE_2MSPS = 0x18
+SAMPLE_RATE_5MSPS = 0x1A
+SAMPLE_RATE_10MSPS = 0x1C
+SAMPLE_RATE_20MSPS = 0x1E
+SAMPLE_RATE_50MSPS = 0x22
+SAMPLE_RATE_100MSPS = 0x24
+SAMPLE_RATE_125MSPS = 0x25
+SAMPLE_RATE_160MSPS = 0x26
+SAMPLE_RATE_180MSPS = 0x27
+
+CHANNEL_A = 1
+CHANNEL_B = 2
+channels = [CHANNEL_A, CHANNEL_B]
+
+AC_COUPLING = 1
+DC_COUPLING = 2
+
+INPUT_RANGE_PM_200_MV = 0x6
+INPUT_RANGE_PM_400_MV = 0x7
+INPUT_RANGE_PM_800_MV = 0x9
+INPUT_RANGE_PM_1_V = 0xA
+INPUT_RANGE_PM_2_V = 0xB
+INPUT_RANGE_PM_4_V = 0xD
+INPUT_RANGE_PM_8_V = 0x10
+INPUT_RANGE_PM_16_V = 0x12
+
+IMPEDANCE_1M_OHM = 1
+IMPEDANCE_50_OHM = 2
+
+TRIG_ENGINE_OP_J = 0
+TRIG_ENGINE_J = 0
+TRIG_ENGINE_K = 1
+TRIG_CHAN_A = 0
+TRIG_CHAN_B = 1
+TRIG_EXTERNAL = 2
+TRIG_DISABLE = 3
+TRIGGER_SLOPE_POSITIVE = 1
+TRIGGER_SLOPE_NEGATIVE = 2
+
+ETR_5V = 0
+ETR_1V = 1
+
+AUX_OUT_TRIGGER = 0
+AUX_OUT_PACER = 18
+
+ADMA_EXTERNAL_STARTCAPTURE = 0x1
+ADMA_TRADITIONAL_MODE = 0x0
+ADMA_CONTINUOUS_MODE = 0x100
+ADMA_NPT = 0x200
+ADMA_TRIGGERED_STREAMING = 0x400
+
+# sample rate flags in Hz
+_sample_rates = {SAMPLE_RATE_1KSPS: 1e3, SAMPLE_RATE_2KSPS: 2e3,
+                 SAMPLE_RATE_5KSPS: 5e3, SAMPLE_RATE_10KSPS: 1e4,
+                 SAMPLE_RATE_20KSPS: 2e4, SAMPLE_RATE_50KSPS: 5e4,
+                 SAMPLE_RATE_100KSPS: 1e5, SAMPLE_RATE_200KSPS: 2e5,
+                 SAMPLE_RATE_500KSPS: 5e5, SAMPLE_RATE_1MSPS: 1e6,
+                 SAMPLE_RATE_2MSPS: 2e6, SAMPLE_RATE_5MSPS: 5e6,
+                 SAMPLE_RATE_10MSPS: 1e7, SAMPLE_RATE_20MSPS: 2e7,
+                 SAMPLE_RATE_50MSPS: 5e7, SAMPLE_RATE_100MSPS: 1e8,
+                 SAMPLE_RATE_125MSPS: 1.25e8, SAMPLE_RATE_160MSPS: 1.6e8,
+                 SAMPLE_RATE_180MSPS: 1.8e8}
+
+class AlazarException(Exception):
+    pass
+
+def enter_pressed():
+    return False
+
+##############
+# SIMULATION #
+##############
+
+# defaults for new simulated boards, see set_simulation
+simulation = {'trigger_rate': 10e3, # records per second
+              'memory_samples': 256 * 1024**2, # on-board memory per channel
+              'bits_per_sample': 16,
+              'signal_freq': 10e6, # Hz, tone on both channels
+              'signal_amplitude': 0.5, # fraction of full scale
+              'noise': 0.01, # rms, fraction of full scale
+              'fill': True} # False leaves buffers untouched, for benchmarks
+
+def set_simulation(**kwargs):
+    # changes the defaults used by simulated boards created afterwards
+    # keywords are the keys of simulation
+    for key in kwargs:
+        if key not in simulation:
+            raise KeyError('Unknown simulation parameter: ' + key)
+    simulation.update(kwargs)
+
+# every simulated buffer by address, so boards can fill buffers that are
+# posted by address like the driver does
+_buffers = {}
+
+# boards by systemId. Boards sharing a systemId are a master/slave system:
+# startCapture on the master (the lowest boardId) starts every armed slave
+_systems = {}
+
+class DMABuffer:
+    # host buffer; memory is ordinary numpy memory instead of page-locked
+
+    def __init__(self, board_handle, c_sample_type, size_bytes):
+        self.size_bytes = size_bytes
+        if c_sample_type == ctypes.c_uint8:
+            dtype = np.uint8
+        else:
+            dtype = np.uint16
+        self.buffer = np.zeros(size_bytes // np.dtype(dtype).itemsize,
+                               dtype = dtype)
+        self.addr = self.buffer.ctypes.data
+        _buffers[self.addr] = self
+
+    def __exit__(self, *args):
+        _buffers.pop(self.addr, None)
+        self.buffer = None
+
+class Board:
+
+    def __init__(self, systemId = 1, boardId = 1):
+        self.systemId = systemId
+        self.boardId = boardId
+        self.handle = ctypes.c_void_p(1000 * systemId + boardId)
+        for key, value in simulation.items():
+            setattr(self, key, value)
+        self.calls = [] # every configuration call, for inspection
+        self.samplesPerSec = 180e6
+        self.record_size = (0, 0)
+        self.capturing = False
+        self.armed = False
+        self.posted = collections.deque()
+        _systems.setdefault(systemId, []).append(self)
+
+    def _record(self, name, *args):
+        self.calls.append((name, args))
+
+    ############
+    # SETTINGS #
+    ############
+
+    def setCaptureClock(self, source, rate, edge, decimation):
+        self._record('setCaptureClock', source, rate, edge, decimation)
+        if source == INTERNAL_CLOCK:
+            self.samplesPerSec = _sample_rates[rate]
+        else:
+            self.samplesPerSec = float(rate)
+        if decimation > 0:
+            self.samplesPerSec /= decimation
+
+    def inputControlEx(self, channel, coupling, input_range, impedance):
+        self._record('inputControlEx', channel, coupling, input_range,
+                     impedance)
+
+    def setBWLimit(self, channel, enable):
+        self._record('setBWLimit', channel, enable)
+
+    def setTriggerOperation(self, *args):
+        self._record('setTriggerOperation', *args)
+
+    def setExternalTrigger(self, coupling, input_range):
+        self._record('setExternalTrigger', coupling, input_range)
+
+    def setTriggerDelay(self, delay):
+        self._record('setTriggerDelay', delay)
+
+    def setTriggerTimeOut(self, timeout):
+        self._record('setTriggerTimeOut', timeout)
+
+    def configureAuxIO(self, mode, param):
+        self._record('configureAuxIO', mode, param)
+
+    def setRecordSize(self, preTriggerSamples, postTriggerSamples):
+        self._record('setRecordSize', preTriggerSamples, postTriggerSamples)
+        self.record_size = (preTriggerSamples, postTriggerSamples)
+
+    def getChannelInfo(self):
+        return (ctypes.c_uint32(self.memory_samples),
+                ctypes.c_uint8(self.bits_per_sample))
+
+    ############
+    # AUTO DMA #
+    ############
+
+    def beforeAsyncRead(self, channels, transferOffset, samplesPerRecord,
+                        recordsPerBuffer, recordsPerAcquisition, flags):
+        self._record('beforeAsyncRead', channels, transferOffset,
+                     samplesPerRecord, recordsPerBuffer,
+                     recordsPerAcquisition, flags)
+        self.channelCount = sum(c & channels == c for c in (CHANNEL_A,
+                                                             CHANNEL_B))
+        self.samplesPerRecord = samplesPerRecord
+        self.recordsPerBuffer = recordsPerBuffer
+        self.flags = flags
+        if flags & (ADMA_CONTINUOUS_MODE | ADMA_TRIGGERED_STREAMING):
+            # samplesPerRecord is the buffer length, one record per buffer
+            self.recordsPerBuffer = 1
+            self.buffer_period = samplesPerRecord / self.samplesPerSec
+        else:
+            self.buffer_period = recordsPerBuffer / self.trigger_rate
+        if recordsPerAcquisition >= 0x7FFFFFFF:
+            self.buffersPerAcquisition = math.inf
+        else:
+            self.buffersPerAcquisition = \
+                recordsPerAcquisition // self.recordsPerBuffer
+        # buffers the on-board memory can hold while the host is behind
+        self.onboard_buffers = self.memory_samples // \
+            (samplesPerRecord * self.recordsPerBuffer)
+        self.posted = collections.deque()
+        self.completed = set()
+        self.buffersFilled = 0
+        self.overflow = False
+        self.template = None
+        self.armed = True
+
+    def postAsyncBuffer(self, addr, size_bytes):
+        if self.capturing:
+            self._advance()
+        self.posted.append(addr)
+
+    def startCapture(self):
+        self._record('startCapture')
+        start_time = time.perf_counter()
+        boards = [self]
+        if self.boardId == min(b.boardId for b in _systems[self.systemId]):
+            boards += [b for b in _systems[self.systemId]
+                       if b is not self and b.armed]
+        for board in boards:
+            board.start_time = start_time
+            board.capturing = True
+
+    def abortAsyncRead(self):
+        self._record('abortAsyncRead')
+        self.capturing = False
+        self.armed = False
+        self.posted = collections.deque()
+
+    def waitAsyncBufferComplete(self, addr, timeout_ms):
+        deadline = time.perf_counter() + timeout_ms / 1000
+        # an armed slave waits for its master to start
+        while self.armed and not self.capturing:
+            if time.perf_counter() > deadline:
+                raise AlazarException('Error: ApiWaitTimeout')
+            time.sleep(1e-4)
+        if not self.capturing:
+            raise AlazarException('Error: ApiBufferNotReady')
+        while True:
+            self._advance()
+            if self.overflow:
+                raise AlazarException('Error: ApiBufferOverflow')
+            if addr in self.completed:
+                self.completed.remove(addr)
+                return
+            if addr not in self.posted:
+                raise AlazarException('Error: ApiBufferNotReady')
+            if self.buffersFilled >= self.buffersPerAcquisition:
+                due = math.inf
+            else:
+                due = self.start_time + \
+                    (self.buffersFilled + 1) * self.buffer_period
+            now = time.perf_counter()
+            if due > deadline:
+                time.sleep(max(deadline - now, 0))
+                raise AlazarException('Error: ApiWaitTimeout')
+            time.sleep(max(due - now, 0))
+
+    def _advance(self):
+        # fills every buffer the board would have filled by now
+        elapsed = time.perf_counter() - self.start_time
+        due = min(int(elapsed / self.buffer_period), self.buffersPerAcquisition)
+        while self.buffersFilled < due and self.posted:
+            addr = self.posted.popleft()
+            self._fill(addr)
+            self.completed.add(addr)
+            self.buffersFilled += 1
+        if due - self.buffersFilled > self.onboard_buffers:
+            self.overflow = True
+
+    def _fill(self, addr):
+        buffer = _buffers.get(addr)
+        if not self.fill or buffer is None or buffer.buffer is None:
+            return
+        data = buffer.buffer
+        if self.template is None or self.template.shape != data.shape:
+            t = np.arange(self.samplesPerRecord) / self.samplesPerSec
+            full = (1 << (8 * data.itemsize - 1)) - 1
+            rng = np.random.default_rng()
+            record = self.signal_amplitude * \
+                np.sin(2 * np.pi * self.signal_freq * t)
+            shape = (data.size // (self.samplesPerRecord * self.channelCount),
+                     self.samplesPerRecord, self.channelCount)
+            noisy = record[None, :, None] + self.noise * \
+                rng.standard_normal(shape)
+            self.template = (full + 1 + full * np.clip(noisy, -1, 1)).astype(
+                data.dtype).ravel()
+        np.copyto(data, self.template)
@@ -8,14 +8,101 @@ Created on Wed Nov 14 16:36:20 2018
 import numpy as np
 import statistics
 import struct
+import threading
+import atexit
+import weakref
 import visa
 import nidaqmx
 
+# One ResourceManager per process and one session per resource string.
+# Instruments on the same address share the session (and its settings, e.g.
+# the timeout), so creating an instrument twice doesn't reopen it
+_resource_manager = None
+_sessions = {} # resource string -> [session, number of instruments using it]
+_sessions_lock = threading.Lock()
+# every gpib_instrument, so close_sessions can make them reopen lazily
+_instruments = weakref.WeakSet()
+
+def resource_manager():
+    # returns the process-wide visa.ResourceManager, created on first use
+    global _resource_manager
+    with _sessions_lock:
+        if _resource_manager is None:
+            _resource_manager = visa.ResourceManager()
+        return _resource_manager
+
+def open_session(addr_str):
+    # returns the pooled session for addr_str, opening it the first time
+    rm = resource_manager()
+    with _sessions_lock:
+        if addr_str not in _sessions:
+            _sessions[addr_str] = [rm.open_resource(addr_str), 0]
+        _sessions[addr_str][1] += 1
+        return _sessions[addr_str][0]
+
+def release_session(addr_str):
+    # closes the session once no instrument uses it any more
+    with _sessions_lock:
+        entry = _sessions.get(addr_str)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _sessions[addr_str]
+            entry[0].close()
+
+def close_sessions():
+    # closes every pooled session and the ResourceManager, also run at exit
+    # Existing instruments reopen their session on their next I/O
+    global _resource_manager
+    with _sessions_lock:
+        for instrument in list(_instruments):
+            instrument._instr = None
+        for session, users in _sessions.values():
+            try:
+                session.close()
+            except Exception as e:
+                print('Error closing VISA session: ' + str(e))
+        _sessions.clear()
+        if _resource_manager is not None:
+            _resource_manager.close()
+            _resource_manager = None
+
+atexit.register(close_sessions)
+
 class gpib_instrument:
+    # lazy = True waits until the first I/O to open the session, so setup
+    # scripts can create instruments without touching the bus. Set it on
+    # the class (gpib_instrument.lazy = True) to make every instrument lazy
+
+    lazy = False
 
     def __init__(self, addr):
-        addr_str = 'GPIB0::'+str(addr)+'::INSTR'
-        self.instr = visa.ResourceManager().open_resource(addr_str)
+        self.addr_str = 'GPIB0::'+str(addr)+'::INSTR'
+        self._instr = None
+        _instruments.add(self)
+        if not self.lazy:
+            self.open()
+
+    def open(self):
+        # gets the shared session for this address, see open_session
+        if self._instr is None:
+            self._instr = open_session(self.addr_str)
+        return self._instr
+
+    @property
+    def instr(self):
+        # the VISA session, opened on first use
+        if self._instr is None:
+            return self.open()
+        return self._instr
+
+    def close(self):
+        # releases the session; it is closed once no other instrument on the
+        # same address uses it
+        if self._instr is not None:
+            self._instr = None
+            release_session(self.addr_str)
     
     def write(self, message, return_output = 0):
         # message = str